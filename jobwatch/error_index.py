@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Inverted index of the errors found by watches across historical reports.
+
+The index is a single JSON file in the report root directory.  Each unique
+error (task, pattern, line) is stored once with the list of its hits (report
+day, log page link and line number), and each normalized token of the error
+line maps to the errors that contain it.  ``search.html`` next to it runs the
+same queries in the browser.
+"""
+
+import os
+import re
+import shutil
+import argparse
+
+from jobwatch.jobwatch import FILEDIR, load_json_state, report_outdir, write_json_atomic
+
+INDEX_FILE = 'error_index.json'
+SEARCH_PAGE = 'search.html'
+
+# Longest error line kept in the index
+MAX_ENTRY_LENGTH = 1000
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    """Return the sorted unique normalized (lower case alphanumeric) tokens in ``text``"""
+    return sorted(set(TOKEN_RE.findall(text.lower())))
+
+
+def format_day(day):
+    """Report directory name YYYYDOY as YYYY:DOY"""
+    return '{}:{}'.format(day[:4], day[4:])
+
+
+def error_href(row, i_line):
+    """Link to the error line relative to the report directory for report ``row``"""
+    page_lines = row['page_lines']
+    log_pages = row['log_pages']
+    if page_lines and i_line // page_lines < len(log_pages):
+        return '{}#error{}'.format(log_pages[i_line // page_lines], i_line)
+    return row['log_html_name']
+
+
+class ErrorIndex(object):
+    """
+    Errors by (task, pattern, line) with their hits as [day, href, i_line].
+    """
+    def __init__(self, rootdir):
+        self.rootdir = rootdir
+        self.filename = os.path.join(rootdir, INDEX_FILE)
+        self.errors = {}
+        index = load_json_state(self.filename)
+        for (task, pattern, line), hits in zip(index.get('errors', []), index.get('hits', [])):
+            self.errors[task, pattern, line] = hits
+
+    def add(self, rows, day):
+        """Add the found errors in report ``rows`` for ``day``, replacing any from that day"""
+        self.remove_days([day])
+        for row in rows:
+            for i_line, line, pattern in row['found_errors']:
+                key = (row['task'], pattern, line.strip()[:MAX_ENTRY_LENGTH])
+                hit = [day, error_href(row, i_line), i_line]
+                self.errors.setdefault(key, []).append(hit)
+
+    def remove_days(self, days):
+        days = set(days)
+        for key in list(self.errors):
+            hits = [hit for hit in self.errors[key] if hit[0] not in days]
+            if hits:
+                self.errors[key] = hits
+            else:
+                del self.errors[key]
+
+    def prune(self):
+        """Remove hits for days whose report directory no longer exists"""
+        days = set(hit[0] for hits in self.errors.values() for hit in hits)
+        self.remove_days([day for day in days
+                          if not os.path.isdir(os.path.join(self.rootdir, day))])
+
+    def write(self):
+        keys = sorted(self.errors)
+        tokens = {}
+        for i_error, (task, pattern, line) in enumerate(keys):
+            for token in tokenize(line):
+                tokens.setdefault(token, []).append(i_error)
+        index = {'errors': [list(key) for key in keys],
+                 'hits': [self.errors[key] for key in keys],
+                 'tokens': tokens}
+        write_json_atomic(self.filename, index, separators=(',', ':'))
+
+
+def update_index(rows, rootdir, datenow=None):
+    """
+    Add the errors in today's report ``rows`` (see ``report_rows()``) to the
+    error index in ``rootdir``.  Run as soon as the report is written.
+    """
+    day = os.path.basename(report_outdir(rootdir, datenow))
+    error_index = ErrorIndex(rootdir)
+    error_index.add(rows, day)
+    error_index.write()
+    shutil.copy(os.path.join(FILEDIR, SEARCH_PAGE), rootdir)
+
+
+def prune_index(rootdir):
+    """
+    Drop days that have been removed from ``rootdir`` from its error index.
+    Run after ``remove_old_reports()``.
+    """
+    error_index = ErrorIndex(rootdir)
+    error_index.prune()
+    error_index.write()
+
+
+def search(rootdir, query, task=None):
+    """
+    Return hits for errors in the index in ``rootdir`` with all tokens in ``query``.
+
+    Each hit is a dict with day, task, pattern, line, href (relative to
+    ``rootdir``) and i_line, newest day first and then by task and line as
+    in ``search.html``.  If ``task`` is given only errors for tasks matching
+    that regex are returned.
+    """
+    index = load_json_state(os.path.join(rootdir, INDEX_FILE),
+                            {'errors': [], 'hits': [], 'tokens': {}})
+
+    error_ids = None
+    for token in tokenize(query):
+        ids = set(index['tokens'].get(token, []))
+        error_ids = ids if error_ids is None else error_ids & ids
+    if error_ids is None:
+        error_ids = range(len(index['errors']))
+
+    results = []
+    for i_error in error_ids:
+        error_task, pattern, line = index['errors'][i_error]
+        if task and not re.search(task, error_task):
+            continue
+        for day, href, i_line in index['hits'][i_error]:
+            results.append({'day': day, 'task': error_task, 'pattern': pattern,
+                            'line': line, 'href': '{}/{}'.format(day, href),
+                            'i_line': i_line})
+    results.sort(key=lambda result: (result['task'], result['i_line']))
+    results.sort(key=lambda result: result['day'], reverse=True)
+    return results
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description='Search errors in skawatch reports')
+    parser.add_argument('query',
+                        nargs='*',
+                        help='Words that must all be in the error line')
+    parser.add_argument('--rootdir',
+                        default='.',
+                        help='Report root directory')
+    parser.add_argument('--task',
+                        help='Only errors for tasks matching this regex')
+    parser.add_argument('--limit',
+                        type=int,
+                        default=100,
+                        help='Maximum number of hits to show (default=100)')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_options()
+    results = search(args.rootdir, ' '.join(args.query), args.task)
+    for result in results[:args.limit]:
+        print('{} {:20s} {:6d}: {}'.format(format_day(result['day']), result['task'],
+                                           result['i_line'], result['line']))
+    if len(results) > args.limit:
+        print('... {} more'.format(len(results) - args.limit))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,13 +8,14 @@ from datetime import datetime
 import pytz
 import requests
 import tables
-from glob import glob
 
 from chandra_time import DateTime
 
+from jobwatch.profiling import RunProfiler
+from jobwatch.plan import load_plan
 from jobwatch import (FileWatch, JobWatch,
                       make_html_report,
-                      set_report_attrs)
+                      report_rows)
 
 SKA = os.environ['SKA']
 HOURS = 1 / 24.
@@ -28,23 +29,44 @@ def get_options():
     parser.add_argument('--jobs',
                         default='ska',
                         help='Jobs to watch ("ska" | "mta", default="ska"')
+    parser.add_argument('--config',
+                        default=os.path.join(FILEDIR, 'hourly_watch.yaml'),
+                        help='Watch configuration file (YAML or TOML)')
     parser.add_argument('--rootdir',
                         default='.',
                         help='Output root directory')
+    parser.add_argument('--state-dir',
+                        help='Directory for caches and scheduler state kept between runs '
+                             '(default=rootdir)')
     parser.add_argument('--email',
                         action='store_true',
                         help='Send email report')
     parser.add_argument('--loud',
                         action='store_true',
                         help='Run loudly')
+    parser.add_argument('--full-check',
+                        action='store_true',
+                        help='Check every watch instead of skipping ones that are not due')
+    parser.add_argument('--report-workers',
+                        type=int,
+                        default=jobwatch.REPORT_WORKERS,
+                        help='Number of threads writing log pages (default=%(default)s)')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help=('Profile the run with cProfile and save stats next to the report '
+                              '(log pages are then written in one thread)'))
+    parser.add_argument('--trace-memory',
+                        action='store_true',
+                        help='Trace memory allocations and save a summary next to the report')
     args = parser.parse_args()
     return args
 
 
 # Ska-specific watchers
 class SkaURLWatch(JobWatch):
+    type = 'URL'
+
     def __init__(self, task, maxage_hours, url=None,):
-        self.type = 'URL'
         self.basename = url
         super(SkaURLWatch, self).__init__(task, url, maxage=maxage_hours * HOURS)
 
@@ -99,7 +121,7 @@ class SkaURLWatch(JobWatch):
         return self._age
 
     @property
-    def filelines(self):
+    def rawlines(self):
         return []
 
 
@@ -124,24 +146,27 @@ class NonSkaFileWatch(FileWatch):
 
 
 class IfotFileWatch(FileWatch):
+    type = 'iFOT query'
+
     def __init__(self, task, maxage_hours, ifotbasename):
         ifot_root = os.path.join(SKA, 'data', 'arc', 'iFOT_events')
-        ifot_files = os.path.join(ifot_root, ifotbasename, "*")
-        filename = sorted(glob(ifot_files))[-1]
+        ifot_dir = os.path.join(ifot_root, ifotbasename)
+        # An empty or missing directory gives a watch on a non-existent file
+        filename = jobwatch.latest_file(ifot_dir) or os.path.join(ifot_dir, '*')
         self.basename = ifotbasename
         super(IfotFileWatch, self).__init__(task, maxage_hours * HOURS, filename)
-        self.type = 'iFOT query'
 
 
 class H5Watch(JobWatch):
+    type = 'H5File'
+
     def __init__(self, task, maxage_hours, filename=None,):
-        self.type = 'H5File'
         full_filename = os.path.join(SKA, 'data', task, filename)
         self.basename = os.path.basename(filename)
         super(H5Watch, self).__init__(task, full_filename, maxage=maxage_hours * HOURS)
 
     @property
-    def filelines(self):
+    def rawlines(self):
         return []
 
     @property
@@ -157,61 +182,47 @@ class H5Watch(JobWatch):
         return self._age
 
 
+WATCH_CLASSES = {cls.__name__: cls
+                 for cls in (SkaURLWatch, SkaWebWatch, SkaFileWatch,
+                             NonSkaFileWatch, IfotFileWatch, H5Watch)}
+
+
 def main():
 
     args = get_options()
-    jobwatch.LOUD = args.loud
-
-    if args.jobs == 'ska':
-        jws = [
-            SkaURLWatch('kadi', 1, 'https://kadi.cfa.harvard.edu'),
-            SkaFileWatch('kadi', 1, 'cmd_events.csv')
-        ]
-    elif args.jobs == 'mta':
-        jws = [
-            SkaURLWatch('arc', 1, 'http://cxc.harvard.edu/mta/ASPECT/arc/index.html'),
-            SkaURLWatch('arc', 1, 'http://cxc.harvard.edu/mta/ASPECT/arc/timeline.png'),
-            SkaURLWatch('arc', 20, 'http://cxc.harvard.edu/mta/ASPECT/arc/ACE_5min.gif'),
-            # SkaURLWatch('arc', 2, 'http://cxc.harvard.edu/mta/ASPECT/arc/GOES_5min.gif'),
-            # SkaURLWatch('arc', 2, 'http://cxc.harvard.edu/mta/ASPECT/arc/GOES_xray.gif'),
-            # SkaURLWatch('arc', 1, 'http://cxc.harvard.edu/mta/ASPECT/arc/hrc_shield.png'),
-            H5Watch('arc', 1, 'ACE.h5'),
-            # H5Watch('arc', 1, 'hrc_shield.h5'),
-            # H5Watch('arc', 1, 'GOES_X.h5'),
-            IfotFileWatch('arc', 1, 'comm'),
-            IfotFileWatch('arc', 1, 'eclipse'),
-            IfotFileWatch('arc', 1, 'grating'),
-            IfotFileWatch('arc', 1, 'grating'),
-            IfotFileWatch('arc', 1, 'load_segment'),
-            IfotFileWatch('arc', 1, 'maneuver'),
-            IfotFileWatch('arc', 1, 'momentum_mon'),
-            IfotFileWatch('arc', 1, 'or_er'),
-            IfotFileWatch('arc', 1, 'radmon'),
-            IfotFileWatch('arc', 1, 'safe'),
-            IfotFileWatch('arc', 1, 'sim'),
-            IfotFileWatch('arc', 1, 'sun_pos_mon'),
-            NonSkaFileWatch('mta snapshot', 1, '/data/mta4/www/Snapshot/chandra.snapshot'),
-            SkaWebWatch('arc', 1, 'index.html'),
-            SkaWebWatch('arc', 1, 'chandra.snapshot'),
-            # SkaWebWatch('arc', 1, 'hrc_shield.png'),
-            # SkaWebWatch('arc', 2, 'GOES_xray.gif'),
-            # SkaWebWatch('arc', 2, 'GOES_5min.gif'),
-            SkaWebWatch('arc', 20, 'ACE_5min.gif')
-        ]
-    else:
+    profiler = RunProfiler(args.profile, args.trace_memory)
+    profiler.start()
+    jobwatch.jobwatch.LOUD = args.loud
+    jobwatch.jobwatch.STAT_CACHE = jobwatch.DirStats()
+    # Run state is kept out of the (public) report directory if possible
+    state_dir = args.state_dir or args.rootdir
+    jobwatch.jobwatch.MTIME_CACHE = jobwatch.MtimeCache(
+        os.path.join(state_dir, 'mtime_cache.json'))
+    jobwatch.jobwatch.SCHEDULER = jobwatch.Scheduler(
+        os.path.join(state_dir, 'schedule.json'), full_check=args.full_check)
+
+    if args.jobs not in ('ska', 'mta'):
         raise ValueError('jobs argument must be either "ska" or "mta"')
+    plan = load_plan(args.config, WATCH_CLASSES, group=args.jobs, cache_dir=state_dir)
+    jws = plan.evaluate(WATCH_CLASSES)
 
-    set_report_attrs(jws)
+    rows = report_rows(jws)
     # Are all the reports OK?
-    report_ok = all([j.ok for j in jws])
-    errors = [job.basename for job in jws if not job.ok]
+    report_ok = all([row['ok'] for row in rows])
+    errors = [row['basename'] for row in rows if not row['ok']]
     # Set the age strings manually to display in hours
-    for jw in jws:
-        jw.age_str = '{:.2f}'.format(jw.age / HOURS) if jw.exists else 'None'
-    index_html = make_html_report(jws, args.rootdir,
+    for row in rows:
+        row['age_str'] = '{:.2f}'.format(row['age'] / HOURS) if row['exists'] else 'None'
+    index_html = make_html_report(rows, args.rootdir,
                                   index_template=os.path.join(FILEDIR,
                                                               'hourly_template.html'),
-                                  just_status=True)
+                                  just_status=True,
+                                  workers=profiler.report_workers(args.report_workers))
+    jobwatch.jobwatch.MTIME_CACHE.save()
+    jobwatch.jobwatch.SCHEDULER.save()
+    profiler.stop()
+    profiler.write(jobwatch.report_outdir(args.rootdir, just_status=True), jws,
+                   name='hourly_{}'.format(args.jobs))
 
     if args.jobs == 'ska':
         recipients = ['aca@cfa.harvard.edu']
@@ -4,10 +4,21 @@ Watch log output from processing jobs and check for problems.
 
 import re
 import os
+import abc
+import glob
+import json
+import fnmatch
 import time
 import smtplib
 from email.mime.text import MIMEText
 import shutil
+import html
+import socket
+import hashlib
+import tempfile
+import functools
+import itertools
+import concurrent.futures
 
 import jinja2
 import ska_dbi
@@ -19,41 +30,437 @@ ERRORS = ('error', 'warn', 'fail', 'fatal', 'exception', 'traceback')
 FILEDIR = os.path.dirname(__file__)
 INDEX_TEMPLATE = os.path.join(FILEDIR, 'index_template.html')
 LOG_TEMPLATE = os.path.join(FILEDIR, 'log_template.html')
+LOG_PAGE_TEMPLATE = os.path.join(FILEDIR, 'log_page_template.html')
+
+# Lines of context shown around each error and lines per page of the full log
+CONTEXT_LINES = 5
+PAGE_LINES = 1000
+
+# Directory in the report root for full log pages shared between reports
+SHARED_PAGES_DIR = 'logs'
+
+# Number of threads that render and write log pages in make_html_report
+REPORT_WORKERS = 4
+
+# Maximum number of bytes of each log line that are searched for patterns
+MAX_LINE_LENGTH = 10000
+
+# Error handler for decoding log lines that are not valid UTF-8
+DECODE_ERRORS = 'backslashreplace'
+
+# Shared DirStats instance used by all watches in a run (None => plain os.stat)
+STAT_CACHE = None
+
+
+class DirStats(object):
+    """
+    Stat results for watched files, collected one directory at a time.
+
+    The first watched file in a directory is stat'ed directly.  Once a second
+    file in the same directory is requested the whole directory is read with a
+    single ``os.scandir`` and all later lookups there (existence, ``.OK``
+    markers and mtimes) are served from the cached ``DirEntry`` objects.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._watched = {}
+        self._stats = {}
+
+    def entries(self, dirname):
+        if dirname not in self._entries:
+            try:
+                with os.scandir(dirname) as it:
+                    self._entries[dirname] = {entry.name: entry for entry in it}
+            except OSError:
+                self._entries[dirname] = {}
+        return self._entries[dirname]
+
+    def _use_listing(self, dirname, name):
+        if dirname in self._entries:
+            return True
+        # A file and its .OK marker count as a single watched file
+        if name.endswith('.OK'):
+            name = name[:-3]
+        watched = self._watched.setdefault(dirname, set())
+        watched.add(name)
+        return len(watched) > 1
+
+    def stat(self, filename):
+        """Return the stat result for ``filename`` or None if it does not exist"""
+        dirname, name = os.path.split(os.path.abspath(filename))
+        if not self._use_listing(dirname, name):
+            if filename not in self._stats:
+                try:
+                    self._stats[filename] = os.stat(filename)
+                except OSError:
+                    self._stats[filename] = None
+            return self._stats[filename]
+
+        entry = self.entries(dirname).get(name)
+        if entry is None:
+            return None
+        try:
+            return entry.stat()
+        except OSError:
+            # Broken symlink or file removed since the directory was read
+            return None
+
+    def exists(self, filename):
+        dirname, name = os.path.split(os.path.abspath(filename))
+        if self._use_listing(dirname, name):
+            entry = self.entries(dirname).get(name)
+            # Only symlinks need a stat call to see if the target exists
+            if entry is None or not entry.is_symlink():
+                return entry is not None
+        return self.stat(filename) is not None
+
+
+def file_exists(filename):
+    if STAT_CACHE is None:
+        return os.path.exists(filename)
+    return STAT_CACHE.exists(filename)
+
+
+def file_mtime(filename):
+    if STAT_CACHE is None:
+        return os.path.getmtime(filename)
+    stat = STAT_CACHE.stat(filename)
+    if stat is None:
+        raise FileNotFoundError('No such file: {}'.format(filename))
+    return stat.st_mtime
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_pattern(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def compile_pattern(pattern):
+    """Compile an error/require pattern (case insensitive) unless already compiled"""
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    return _compile_pattern(pattern)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_bytes_pattern(pattern):
+    return re.compile(pattern.encode('utf-8'), re.IGNORECASE)
+
+
+def compile_bytes_pattern(pattern):
+    """
+    Compile an error/require pattern (case insensitive) to search raw log lines.
+
+    Case folding and classes like ``\\w`` then only cover ASCII characters.
+    """
+    if isinstance(pattern, re.Pattern):
+        if isinstance(pattern.pattern, bytes):
+            return pattern
+        return re.compile(pattern.pattern.encode('utf-8'), pattern.flags & ~re.UNICODE)
+    return _compile_bytes_pattern(pattern)
+
+
+def decode_line(line):
+    """Decode a raw log line, replacing bytes that are not valid UTF-8"""
+    if isinstance(line, bytes):
+        return line.decode('utf-8', DECODE_ERRORS)
+    return line
+
+
+def load_json_state(filename, default=None):
+    """
+    Return the contents of the JSON state file ``filename``.
+
+    If there is no such file, or it is corrupt (e.g. from a partial write),
+    ``default`` is returned (an empty dict if None) so that the state starts
+    over.
+    """
+    if default is None:
+        default = {}
+    if filename is None or not os.path.exists(filename):
+        return default
+    try:
+        with open(filename, 'r') as fh:
+            return json.load(fh)
+    except ValueError:
+        return default
+
+
+def write_json_atomic(filename, data, **kwargs):
+    """
+    Write ``data`` as JSON to ``filename`` via a temporary file and a rename.
+
+    Readers (and other processes writing the same file) never see a partial
+    file.  ``kwargs`` are passed on to ``json.dump()``.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmpfile, 'w') as fh:
+        json.dump(data, fh, **kwargs)
+    os.replace(tmpfile, filename)
+
+
+class MtimeCache(object):
+    """
+    Values derived from a file or directory, cached on its mtime.
+
+    If ``filename`` is given the cache is loaded from and saved to that JSON
+    file so that results carry over between runs.  Cached values must be JSON
+    serializable.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._cache = load_json_state(filename)
+
+    def get(self, key, path, func):
+        """
+        Return ``func()``, only calling it again when the mtime of ``path`` changes.
+        """
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        value = func()
+        self._cache[key] = [mtime, value]
+        return value
+
+    def save(self):
+        if self.filename is not None:
+            write_json_atomic(self.filename, self._cache)
+
+
+# Shared MtimeCache instance, replaced by a persistent one in the scripts
+MTIME_CACHE = MtimeCache()
+
+# Shared Scheduler instance (None => check every watch)
+SCHEDULER = None
+
+
+class Scheduler(object):
+    """
+    Skip checks of watches that cannot be due and carry their last result forward.
+
+    For each watch the time of the last update (``filetime``) and the last
+    few observed intervals between updates are saved in the JSON ``filename``.
+    A watch that was OK when last checked is not checked again until
+    ``skip_fraction`` of its maxage or of its shortest observed update
+    interval (whichever is less) has passed since its last update, and only
+    while the mtime of the file backing the watch (the watch or probe
+    ``filename``) and the watch settings (patterns and maxage) are
+    unchanged.  Watches with maxage <= 0, no backing file or a problem in the
+    last check are always checked.  Only watches checked or carried forward
+    in this run are saved.
+    """
+    def __init__(self, filename=None, skip_fraction=0.5, n_intervals=5, full_check=False):
+        self.filename = filename
+        self.skip_fraction = skip_fraction
+        self.n_intervals = n_intervals
+        self.full_check = full_check
+        self._state = load_json_state(filename)
+        self._used = set()
+
+    @staticmethod
+    def key(jw):
+        return '{}:{}:{}'.format(getattr(jw, 'type', 'Job'), jw.task, jw.filename)
+
+    @staticmethod
+    def source_mtime(jw):
+        """Current mtime of the file backing ``jw``, or None if there is no such file"""
+        probe = getattr(jw, 'probe', None)
+        try:
+            return file_mtime(probe.filename if probe is not None else jw.filename)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def settings(jw):
+        """Digest of the settings of ``jw`` that its result depends on"""
+        settings = [[getattr(pattern, 'pattern', pattern) for pattern in getattr(jw, attr, ())]
+                    for attr in ('errors', 'exclude_errors', 'requires')]
+        settings.append(jw.maxage)
+        return hashlib.sha1(json.dumps(settings, default=str).encode('utf-8')).hexdigest()
+
+    def next_check(self, jw):
+        """
+        Return the unix time when ``jw`` is next due for a check, or None if unknown.
+        """
+        state = self._state.get(self.key(jw))
+        if state is None or not state['ok'] or jw.maxage <= 0:
+            return None
+        interval = min([jw.maxage] + state['intervals'])
+        return state['filetime'] + self.skip_fraction * interval * 86400
+
+    def restore(self, jw):
+        """
+        Set the last result on ``jw`` and return True if it does not need a check.
+        """
+        if self.full_check:
+            return False
+        next_check = self.next_check(jw)
+        if next_check is None or time.time() >= next_check:
+            return False
+        key = self.key(jw)
+        state = self._state[key]
+        mtime = self.source_mtime(jw)
+        if mtime is None or mtime != state.get('mtime'):
+            return False
+        if state.get('settings') != self.settings(jw):
+            return False
+
+        self._used.add(key)
+        jw.filetime = state['filetime']
+        jw.filedate = time.ctime(jw.filetime)
+        jw._exists = True
+        jw._age = (time.time() - jw.filetime) / 86400.0
+        jw._rawlines = []
+        # The log is unchanged so the report can still show it
+        jw._checked_log = (state.get('log_size', 0), state.get('n_lines', 0))
+        jw.stale = jw._age > jw.maxage
+        jw.missing_requires = set()
+        jw.found_errors = []
+        jw.carried_from = time.ctime(state['checked'])
+        if LOUD:
+            print('Carrying forward ', repr(jw))
+        return True
+
+    def record(self, jw):
+        """
+        Record the result of checking ``jw`` and the observed update interval.
+        """
+        key = self.key(jw)
+        state = self._state.get(key, {})
+        intervals = state.get('intervals', [])
+        if (jw.filetime is not None and state.get('filetime') is not None and
+                jw.filetime > state['filetime']):
+            interval = (jw.filetime - state['filetime']) / 86400.0
+            intervals = (intervals + [interval])[-self.n_intervals:]
+        ok = (jw.filetime is not None and jw.exists and
+              not (jw.stale or jw.missing_requires or jw.found_errors))
+        log_size, n_lines = jw.checked_log
+        self._used.add(key)
+        self._state[key] = {'checked': time.time(),
+                            'filetime': jw.filetime,
+                            'mtime': self.source_mtime(jw),
+                            'settings': self.settings(jw),
+                            'log_size': log_size,
+                            'n_lines': n_lines,
+                            'intervals': intervals,
+                            'ok': bool(ok)}
+
+    def save(self):
+        if self.filename is None:
+            return
+        # Keys change as new files arrive (e.g. the latest log) so drop the rest
+        self._state = {key: self._state[key] for key in self._used}
+        write_json_atomic(self.filename, self._state)
+
+
+def _scan_latest(dirname, pattern):
+    latest = None
+    with os.scandir(dirname) as it:
+        for entry in it:
+            name = entry.name
+            # Skip hidden files as glob does
+            if name.startswith('.') and not pattern.startswith('.'):
+                continue
+            if (latest is None or name > latest) and fnmatch.fnmatch(name, pattern):
+                latest = name
+    return latest
+
+
+def latest_file(dirname, pattern='*'):
+    """
+    Return the last file (by name) in ``dirname`` matching ``pattern``.
+
+    This is equivalent to ``sorted(glob(os.path.join(dirname, pattern)))[-1]``
+    but does not sort, and the directory is only listed again when its mtime
+    changes.  Returns None if the directory is missing or has no match.
+    """
+    if not os.path.isdir(dirname):
+        return None
+    key = 'latest_file:' + os.path.join(dirname, pattern)
+    latest = MTIME_CACHE.get(key, dirname, lambda: _scan_latest(dirname, pattern))
+    return None if latest is None else os.path.join(dirname, latest)
+
+
+class Probe(abc.ABC):
+    """
+    Freshness probe for an application data source backed by ``filename``.
+
+    Subclasses implement ``last_time()`` to return the unix time of the most
+    recent record in the data source, ideally by reading only that record.
+    The ``time`` property caches this on the mtime of ``filename``.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    @abc.abstractmethod
+    def last_time(self):
+        """Return the unix time of the most recent record in the data source"""
+
+    @property
+    def time(self):
+        key = '{}:{}'.format(self.__class__.__name__, self.filename)
+        return MTIME_CACHE.get(key, self.filename, self.last_time)
 
 
 class JobWatch(object):
+    # Watch type, shown in the report and used with the task to identify watches
+    type = 'Job'
+
     def __init__(self, task, filename,
                  errors=(),
                  requires=(),
                  maxage=1,
-                 exclude_errors=()):
+                 exclude_errors=(),
+                 probe=None):
         self.task = task
         self._filename = filename
         self.errors = errors
         self.exclude_errors = exclude_errors
         self.requires = requires
         self.maxage = maxage
+        self.probe = probe
         self.filetime = None
         self.filedate = None
-        self.check()
+        t0 = time.perf_counter()
+        if SCHEDULER is None or not SCHEDULER.restore(self):
+            self.check()
+            if SCHEDULER is not None:
+                SCHEDULER.record(self)
+        self.check_secs = time.perf_counter() - t0
 
     @property
     def filename(self):
         return self._filename.format(**self.__dict__)
 
     @property
-    def filelines(self):
-        if not hasattr(self, '_filelines'):
+    def rawlines(self):
+        """
+        Lines of the file as bytes.  Subclasses return [] to skip the scan.
+
+        Lines end at \\n, \\r\\n or a bare \\r (e.g. progress output) as in
+        text mode.
+        """
+        if not hasattr(self, '_rawlines'):
             if self.exists:
-                self._filelines = open(self.filename, 'r').readlines()
+                with open(self.filename, 'rb') as fh:
+                    self._rawlines = fh.read().splitlines(keepends=True)
             else:
-                self._filelines = []
-        return self._filelines
+                self._rawlines = []
+        return self._rawlines
+
+    @property
+    def filelines(self):
+        return [decode_line(line) for line in self.rawlines]
 
     @property
     def age(self):
         if not hasattr(self, '_age'):
-            self.filetime = os.path.getmtime(self.filename)
+            if self.probe is not None:
+                self.filetime = self.probe.time
+            else:
+                self.filetime = file_mtime(self.filename)
             self.filedate = time.ctime(self.filetime)
             self._age = (time.time() - self.filetime) / 86400.0
         return self._age
@@ -61,13 +468,59 @@ class JobWatch(object):
     @property
     def exists(self):
         if not hasattr(self, '_exists'):
-            self._exists = os.path.exists(self.filename)
+            self._exists = file_exists(self.filename)
         return self._exists
 
+    def iter_rawlines(self):
+        return iter(self.rawlines)
+
+    def iter_lines(self):
+        return (decode_line(line) for line in self.rawlines)
+
+    @property
+    def n_lines(self):
+        return len(self.rawlines)
+
+    @property
+    def checked_log(self):
+        """(bytes, lines) of the log that was read for the check, (0, 0) if none"""
+        if not hasattr(self, '_checked_log'):
+            rawlines = getattr(self, '_rawlines', None) or []
+            self._checked_log = (sum(len(line) for line in rawlines), len(rawlines))
+        return self._checked_log
+
+    def result(self):
+        """
+        Return the result of evaluating this watch as a compact WatchResult.
+
+        The result does not keep the log lines, so once the watch itself is
+        dropped they can be freed.
+        """
+        exists = self.exists
+        age = self.age if exists else None
+        log_size, n_lines = self.checked_log
+        return WatchResult(type=getattr(self, 'type', 'Job'),
+                           task=self.task,
+                           filename=self.filename,
+                           basename=getattr(self, 'basename', None),
+                           maxage=self.maxage,
+                           exists=exists,
+                           age=age,
+                           filetime=self.filetime,
+                           filedate=self.filedate,
+                           stale=self.stale,
+                           missing_requires=set(self.missing_requires),
+                           found_errors=list(self.found_errors),
+                           carried_from=getattr(self, 'carried_from', None),
+                           check_secs=getattr(self, 'check_secs', 0.0),
+                           log_filename=self.filename if n_lines else None,
+                           log_size=log_size,
+                           n_lines=n_lines)
+
     def check(self):
         if LOUD:
             print('Checking ', repr(self))
-        if os.path.exists(self.filename + '.OK') or not self.exists:
+        if file_exists(self.filename + '.OK') or not self.exists:
             self.stale = False
             self.missing_requires = set()
             self.found_errors = []
@@ -75,19 +528,28 @@ class JobWatch(object):
 
         self.stale = self.age > self.maxage
 
+        # Search the raw bytes and only decode the lines with errors
+        errors = [(error, compile_bytes_pattern(error)) for error in self.errors]
+        exclude_errors = [compile_bytes_pattern(exclude_error)
+                          for exclude_error in self.exclude_errors]
+        requires = [(require, compile_bytes_pattern(require)) for require in self.requires]
+
         found_requires = set()
         found_errors = []
-        for i, line in enumerate(self.filelines):
-            for error in self.errors:
-                if (re.search(error, line, re.IGNORECASE) and
-                    not any(re.search(exclude_error, line, re.IGNORECASE)
-                            for exclude_error in self.exclude_errors)):
+        for i, line in enumerate(self.rawlines):
+            # Cap the text searched so a pathological line cannot stall the scan
+            search_line = line[:MAX_LINE_LENGTH]
+            for error, error_re in errors:
+                if (error_re.search(search_line) and
+                    not any(exclude_re.search(search_line)
+                            for exclude_re in exclude_errors)):
+                    line = decode_line(line)
                     if LOUD:
                         print('MATCH: {}\n    {}'.format(
                             error, line), end=' ')
                     found_errors.append((i, line, error))
-            for require in self.requires:
-                if re.search(require, line, re.IGNORECASE):
+            for require, require_re in requires:
+                if require_re.search(search_line):
                     found_requires.add(require)
 
         self.missing_requires = set(self.requires) - found_requires
@@ -101,14 +563,15 @@ class FileWatch(JobWatch):
     """Watch the date of a file but do not look into the file contents for
     errors.
     """
+    type = 'File'
+
     def __init__(self, task, maxage=1,
                  filename=None):
-        self.type = 'File'
         super(FileWatch, self).__init__(task, filename, maxage=maxage,
                                         errors=(), requires=())
 
     @property
-    def filelines(self):
+    def rawlines(self):
         return []
 
 
@@ -134,7 +597,7 @@ class DbWatch(JobWatch):
         return self._query.format(**self.__dict__)
 
     @property
-    def filelines(self):
+    def rawlines(self):
         return []
 
     @property
@@ -154,43 +617,349 @@ class DbWatch(JobWatch):
         return self._age
 
 
-def set_report_attrs(jobwatches):
-    error_line = '<a name=error{0}><span class="red">{1}</span></a>'
+def watch_record(jw):
+    """
+    Return the result of evaluating ``jw`` as a JSON-serializable dict.
+    """
+    exists = jw.exists
+    return {'type': getattr(jw, 'type', 'Job'),
+            'task': jw.task,
+            'filename': os.path.abspath(jw.filename),
+            'maxage': jw.maxage,
+            'exists': exists,
+            'age': jw.age if exists else None,
+            'filetime': jw.filetime,
+            'filedate': jw.filedate,
+            'stale': jw.stale,
+            'missing_requires': sorted(jw.missing_requires),
+            'found_errors': [list(found_error) for found_error in jw.found_errors]}
+
+
+RESULT_FIELDS = ('type', 'task', 'filename', 'basename', 'maxage', 'exists', 'age',
+                 'filetime', 'filedate', 'stale', 'missing_requires', 'found_errors',
+                 'carried_from', 'check_secs', 'log_filename', 'log_size', 'n_lines')
+
+
+class WatchResult(object):
+    """
+    Result of evaluating a watch with only the fields that reports need.
+
+    The fields come from the evaluated watch (see ``JobWatch.result()``) or
+    from a ``watch_record()`` dict, e.g. one written by an agent on another
+    node.  How a result is shown is kept separately in its ``report_rows()``
+    row.  Log lines are not kept: ``iter_lines()`` reads the log again when a
+    report needs it.
+    """
+    __slots__ = RESULT_FIELDS
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError('unknown WatchResult fields: {}'.format(', '.join(sorted(fields))))
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Result from a ``watch_record()`` dict.  The log itself is not
+        available so only the lines with errors are shown in the report.
+        """
+        return cls(type=record['type'],
+                   task=record['task'],
+                   filename=record['filename'],
+                   maxage=record['maxage'],
+                   exists=record['exists'],
+                   age=record['age'],
+                   filetime=record['filetime'],
+                   filedate=record['filedate'],
+                   stale=record['stale'],
+                   missing_requires=set(record['missing_requires']),
+                   found_errors=[tuple(found_error) for found_error in record['found_errors']],
+                   check_secs=0.0,
+                   log_size=0,
+                   n_lines=0)
+
+    def iter_rawlines(self):
+        """
+        Read the lines (as bytes) of the log that was checked, if any.
+
+        Only the first ``log_size`` bytes, which were checked, are read so
+        lines appended since then are not shown.  A log that is now smaller
+        (e.g. rotated) is not read at all.
+        """
+        if self.log_filename is None:
+            return
+        try:
+            fh = open(self.log_filename, 'rb')
+        except OSError:
+            return
+        with fh:
+            if os.fstat(fh.fileno()).st_size < self.log_size:
+                return
+            remaining = self.log_size
+            while remaining > 0:
+                line = fh.readline(remaining)
+                if not line:
+                    break
+                remaining -= len(line)
+                # Split at bare \r as well, as in JobWatch.rawlines
+                yield from line.splitlines(keepends=True)
+
+    def iter_lines(self):
+        return (decode_line(line) for line in self.iter_rawlines())
+
+    def result(self):
+        """A WatchResult is its own result, as for ``JobWatch.result()``"""
+        return self
+
+    def __repr__(self):
+        return '<WatchResult type={} task={}>'.format(self.type, self.task)
+
+
+class AgentWatch(FileWatch):
+    """Watch the shard file written by an agent to detect agents that stopped"""
+    type = 'Agent'
+
+    def __init__(self, task, maxage=1, filename=None):
+        super(AgentWatch, self).__init__(task, maxage=maxage, filename=filename)
+
+
+def write_shard(jobwatches, spooldir, agent=None):
+    """
+    Write results for ``jobwatches`` as a JSON shard ``<agent>.json`` in ``spooldir``.
+
+    The shard is written to a temporary file and then renamed so that an
+    aggregator never reads a partial shard.  Each agent only writes its own
+    shard so any number of agents can run concurrently.
+    """
+    if agent is None:
+        agent = socket.gethostname()
+    shard = {'agent': agent,
+             'host': socket.gethostname(),
+             'time': time.time(),
+             'watches': [watch_record(jw) for jw in jobwatches]}
+    filename = os.path.join(spooldir, '{}.json'.format(agent))
+    write_json_atomic(filename, shard, separators=(',', ':'))
+    return filename
+
+
+def read_shards(spooldir, maxage=1):
+    """
+    Read all agent shards in ``spooldir``.
+
+    Returns a list of WatchResult for the results in the shards, followed by
+    the result of an AgentWatch for each shard which is stale if the agent
+    has not written its shard within ``maxage`` days.  A shard that cannot
+    be read is reported as an error of its AgentWatch.
+    """
+    record_watches = []
+    agent_watches = []
+    for filename in sorted(glob.glob(os.path.join(spooldir, '*.json'))):
+        agent = os.path.splitext(os.path.basename(filename))[0]
+        agent_watch = AgentWatch('agent {}'.format(agent), maxage=maxage,
+                                 filename=filename).result()
+        try:
+            with open(filename, 'r') as fh:
+                shard = json.load(fh)
+            records = [WatchResult.from_record(record) for record in shard['watches']]
+        except (OSError, ValueError, KeyError) as err:
+            agent_watch.found_errors = [
+                (0, 'Unreadable shard {}: {!r}\n'.format(filename, err), 'shard')]
+        else:
+            record_watches.extend(records)
+        agent_watches.append(agent_watch)
+    return record_watches + agent_watches
+
+
+def shards_by_key(shard_watches):
+    """
+    Return a dict of the watches in ``shard_watches`` by (type, task).
+
+    Local watches with these keys are replaced by ``merge_shards()`` so they
+    need not be evaluated.
+    """
+    by_key = {}
+    for jw in shard_watches:
+        by_key.setdefault((getattr(jw, 'type', 'Job'), jw.task), []).append(jw)
+    return by_key
+
+
+def merge_shards(jobwatches, shard_watches):
+    """
+    Merge watches read from agent shards into the locally evaluated ``jobwatches``.
+
+    An agent owns each (type, task) it reports: local watches with the same
+    type and task are replaced by the agent results, in the position of the
+    first local one.  Other shard watches are appended at the end.
+    """
+    by_key = shards_by_key(shard_watches)
+    merged = []
+    merged_keys = set()
+    for jw in jobwatches + shard_watches:
+        key = (getattr(jw, 'type', 'Job'), jw.task)
+        if key not in by_key:
+            merged.append(jw)
+        elif key not in merged_keys:
+            merged.extend(by_key[key])
+            merged_keys.add(key)
+    return merged
+
+
+def error_windows(lines, found_errors, context_lines=CONTEXT_LINES):
+    """
+    Return context windows of +/- ``context_lines`` around each found error.
+
+    Overlapping windows are merged.  Each window is a list of (i_line, line,
+    is_error) tuples, with lines decoded if ``lines`` are bytes.  Lines past
+    the end of ``lines`` (e.g. for a result from an agent where the log is not
+    available) are taken from ``found_errors`` if possible and otherwise
+    skipped.
+    """
+    error_lines = {i_line: line for i_line, line, _ in found_errors}
+    ranges = []
+    for i_line in sorted(error_lines):
+        start = max(i_line - context_lines, 0)
+        stop = i_line + context_lines + 1
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], stop)
+        else:
+            ranges.append([start, stop])
+
+    windows = []
+    for start, stop in ranges:
+        window = []
+        for i_line in range(start, stop):
+            if i_line < len(lines):
+                window.append((i_line, decode_line(lines[i_line]), i_line in error_lines))
+            elif i_line in error_lines:
+                window.append((i_line, error_lines[i_line], True))
+        windows.append(window)
+    return windows
+
+
+def log_page_name(log_html_name, i_page):
+    return '{}_{}.html'.format(log_html_name[:-5], i_page)
+
+
+def shared_page_name(result, page_lines, i_page):
+    """
+    Link from a report directory to a page of the log of ``result`` shared
+    between reports.  The name changes whenever the log does.
+    """
+    key = '\n'.join(str(value) for value in (result.task, os.path.abspath(result.log_filename),
+                                             result.log_size, result.filetime, page_lines))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return '../{}/{}_{}.html'.format(SHARED_PAGES_DIR, digest, i_page)
+
+
+def report_rows(jobwatches, context_lines=CONTEXT_LINES, page_lines=PAGE_LINES):
+    """
+    Return the report rows for ``jobwatches`` (watches or WatchResults).
 
+    Each row is a dict of the WatchResult fields (see ``RESULT_FIELDS``) and
+    what the index and log page templates show for it, with the WatchResult
+    itself as ``result`` for reading the log again.  The watches and results
+    are not changed.
+    """
+    rows = []
+    last_type = None
     for i_jw, jw in enumerate(jobwatches):
-        jw.ok = jw.exists and not (jw.stale or
-                                   jw.missing_requires or
-                                   jw.found_errors)
-
-        jw.abs_filename = os.path.abspath(jw.filename)
-        jw.log_html_name = 'log{}.html'.format(i_jw)
-        jw.age_str = '{:.2f}'.format(jw.age) if jw.exists else 'None'
-        if jw.stale:
-            jw.age_str = '<span style="color:red";>{}</span>'.format(
-                jw.age_str)
-
-        this_type = getattr(jw, 'type', 'Job')
-        last_type = getattr(jobwatches[i_jw - 1], 'type', 'Job')
-        if i_jw == 0 or this_type != last_type:
-            jw.span_cols_text = this_type
+        result = jw.result()
+        row = {name: getattr(result, name) for name in RESULT_FIELDS}
+        row['result'] = result
+        row['ok'] = result.exists and not (result.stale or
+                                           result.missing_requires or
+                                           result.found_errors)
+
+        row['abs_filename'] = os.path.abspath(result.filename)
+        row['log_html_name'] = 'log{}.html'.format(i_jw)
+        row['age_str'] = '{:.2f}'.format(result.age) if result.exists else 'None'
+        if result.stale:
+            row['age_str'] = '<span style="color:red";>{}</span>'.format(
+                row['age_str'])
+
+        this_type = result.type
+        row['span_cols_text'] = this_type if i_jw == 0 or this_type != last_type else None
+        last_type = this_type
 
+        row['overlib'] = ''
         maxerrs = 10
-        if not jw.ok and jw.found_errors:
+        if not row['ok'] and result.found_errors:
             popups = [re.sub(r'[\'"]', '', line.strip())
-                      for _, line, _ in jw.found_errors[:maxerrs]]
-            if len(jw.found_errors) > maxerrs:
+                      for _, line, _ in result.found_errors[:maxerrs]]
+            if len(result.found_errors) > maxerrs:
                 popups.append('AND {} MORE'.format(
-                    len(jw.found_errors) - maxerrs))
+                    len(result.found_errors) - maxerrs))
             popup = '<br/>'.join(popups)
-            jw.overlib = ('ONMOUSEOVER="return overlib (\'{}\', WIDTH, 600);" '
-                          'ONMOUSEOUT="return nd();"'.format(popup))
+            row['overlib'] = ('ONMOUSEOVER="return overlib (\'{}\', WIDTH, 600);" '
+                              'ONMOUSEOUT="return nd();"'.format(popup))
+
+        # The log page shows only the context around errors, with links into
+        # the paged view of the full log.  Pages of a log without errors are
+        # shared between reports so they are only written when the log changes.
+        lines = list(result.iter_rawlines()) if result.found_errors else []
+        row['error_windows'] = error_windows(lines, result.found_errors, context_lines)
+        row['page_lines'] = page_lines
+        n_pages = -(-result.n_lines // page_lines) if page_lines else 0
+        if result.found_errors:
+            row['log_pages'] = [log_page_name(row['log_html_name'], i_page)
+                                for i_page in range(n_pages)]
+        else:
+            row['log_pages'] = [shared_page_name(result, page_lines, i_page)
+                                for i_page in range(n_pages)]
+
+        row['prev_index'] = ''
+        rows.append(row)
+    return rows
+
+
+def write_log_pages(row, outdir, page_template):
+    """
+    Write the full log for report ``row`` as pages of ``page_lines`` lines.
+
+    The log is read one page at a time.  Shared pages (see
+    ``shared_page_name()``) that already exist are not written again, just
+    touched so that ``remove_old_reports()`` keeps them.
+    """
+    if not row['log_pages']:
+        return
+    page_dir = os.path.normpath(os.path.join(outdir, os.path.dirname(row['log_pages'][0])))
+    page_names = [os.path.basename(page) for page in row['log_pages']]
+    shared = page_dir != os.path.normpath(outdir)
+    log_html_name = None if shared else row['log_html_name']
+    if shared:
+        page_files = [os.path.join(page_dir, page_name) for page_name in page_names]
+        if all(os.path.exists(page_file) for page_file in page_files):
+            for page_file in page_files:
+                os.utime(page_file)
+            return
+        os.makedirs(page_dir, exist_ok=True)
 
-        html_lines = list(jw.filelines)
-        for i_line, line, error in jw.found_errors:
-            html_lines[i_line] = error_line.format(i_line, line)
-        jw.html_lines = '<br/>'.join(html_lines)
+    error_lines = set(i_line for i_line, _, _ in row['found_errors'])
+    lines = row['result'].iter_rawlines()
+    page_lines = row['page_lines']
+    for i_page, page_name in enumerate(page_names):
+        start = i_page * page_lines
+        html_lines = []
+        for i_line, line in enumerate(itertools.islice(lines, page_lines), start):
+            line = html.escape(decode_line(line).rstrip('\n'))
+            if i_line in error_lines:
+                line = '<a name=error{0}><span class="red">{0}: {1}</span></a>'.format(
+                    i_line, line)
+            else:
+                line = '{}: {}'.format(i_line, line)
+            html_lines.append(line)
 
-        jw.prev_index = ''
+        page_html = page_template.render(
+            task=row['task'], abs_filename=row['abs_filename'],
+            log_html_name=log_html_name, log_pages=page_names,
+            i_page=i_page, start=start, stop=start + len(html_lines),
+            n_lines=row['n_lines'], html_lines='<br/>\n'.join(html_lines))
+        # Shared pages may be written by more than one report at a time
+        with tempfile.NamedTemporaryFile('w', dir=page_dir, suffix='.tmp',
+                                         delete=False) as outfile:
+            outfile.write(page_html)
+        os.replace(outfile.name, os.path.join(page_dir, page_name))
 
 
 def runtime_long(datenow):
@@ -211,19 +980,45 @@ def rundate(datenow):
         now.date[:8], time.strftime('%a %b %d', time.gmtime(now.unix)))
 
 
-def make_html_report(jobwatches, rootdir, datenow=None,
-                     index_template=INDEX_TEMPLATE, just_status=False):
+def report_outdir(rootdir, datenow=None, just_status=False):
     if just_status:
-        outdir = os.path.join(rootdir, 'status')
-    else:
+        return os.path.join(rootdir, 'status')
+    return os.path.join(rootdir, DateTime(datenow).greta[:7])
+
+
+def write_log_html(row, outdir, log_template, page_template, prefixes):
+    """
+    Write the log page and the paged full log for report ``row``.
+    """
+    log_html = log_template.render(**prefixes, **row)
+    with open(os.path.join(outdir, row['log_html_name']), 'w') as outfile:
+        outfile.write(log_html)
+    write_log_pages(row, outdir, page_template)
+
+
+def make_html_report(rows, rootdir, datenow=None,
+                     index_template=INDEX_TEMPLATE, just_status=False,
+                     workers=REPORT_WORKERS):
+    """
+    Write the index and log pages for report ``rows`` (see ``report_rows()``)
+    and return the index HTML.
+
+    Log pages are rendered and written by a pool of ``workers`` threads so
+    rendering overlaps with file writes, while the index is rendered and
+    written straight away from the per-watch summaries.  Returns once all
+    pages are written.  With ``workers`` <= 1 the pages are written first
+    in the calling thread.
+    """
+    outdir = report_outdir(rootdir, datenow, just_status)
+    if not just_status:
         currdir = DateTime(datenow).greta[:7]
         prevdir = (DateTime(datenow) - 1).greta[:7]
         nextdir = (DateTime(datenow) + 1).greta[:7]
-        outdir = os.path.join(rootdir, currdir)
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
     log_template = jinja2.Template(open(LOG_TEMPLATE, 'r').read())
+    page_template = jinja2.Template(open(LOG_PAGE_TEMPLATE, 'r').read())
     root_prefix = '../{}/'
     curr_prefix = ''
     if just_status:
@@ -232,57 +1027,65 @@ def make_html_report(jobwatches, rootdir, datenow=None,
     else:
         prev_prefix = root_prefix.format(prevdir)
         next_prefix = root_prefix.format(nextdir)
-    for i_jw, jw in enumerate(jobwatches):
-        jw.http_prefix = curr_prefix
-        if not just_status:
-            jw.prev_http_prefix = prev_prefix
-            jw.next_http_prefix = next_prefix
-        log_html = log_template.render(**jw.__dict__)
+    prefixes = {'http_prefix': curr_prefix,
+                'prev_http_prefix': prev_prefix,
+                'next_http_prefix': next_prefix}
 
-        outfile = open(os.path.join(outdir, jw.log_html_name), 'w')
-        outfile.write(log_html)
+    futures = []
+    executor = None
+    if workers > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        futures = [executor.submit(write_log_html, row, outdir,
+                                   log_template, page_template, prefixes)
+                   for row in rows]
+    else:
+        # Write the pages in this thread, e.g. so that cProfile (which only
+        # sees the thread that enabled it) includes them
+        for row in rows:
+            write_log_html(row, outdir, log_template, page_template, prefixes)
+
+    try:
+        index_template = jinja2.Template(open(index_template, 'r').read())
+        index_html = index_template.render(jobwatches=rows,
+                                           rundate=rundate(datenow),
+                                           runtime=runtime(datenow),
+                                           runtime_long=runtime_long(datenow),
+                                           curr_prefix=curr_prefix,
+                                           next_prefix=next_prefix,
+                                           prev_prefix=prev_prefix,
+                                           )
+
+        outfile = open(os.path.join(outdir, 'index.html'), 'w')
+        outfile.write(index_html)
         outfile.close()
 
-    index_template = jinja2.Template(open(index_template, 'r').read())
-    index_html = index_template.render(jobwatches=jobwatches,
-                                       rundate=rundate(datenow),
-                                       runtime=runtime(datenow),
-                                       runtime_long=runtime_long(datenow),
-                                       curr_prefix=curr_prefix,
-                                       next_prefix=next_prefix,
-                                       prev_prefix=prev_prefix,
-                                       )
-
-    outfile = open(os.path.join(outdir, 'index.html'), 'w')
-    outfile.write(index_html)
-    outfile.close()
-
-    # Copy the overlib.js into outdir if not there.  This is hardcoded
-    # in the common templates.
-    if not os.path.exists(os.path.join(outdir, 'overlib.js')):
-        shutil.copy(os.path.join(FILEDIR, 'overlib.js'),
-                    outdir)
+        # Copy the overlib.js into outdir if not there.  This is hardcoded
+        # in the common templates.
+        if not os.path.exists(os.path.join(outdir, 'overlib.js')):
+            shutil.copy(os.path.join(FILEDIR, 'overlib.js'),
+                        outdir)
 
-    if just_status:
-        return index_html
-
-    # Set an absolute http_prefix for the emailed version of index.html
-    root_prefix = 'http://cxc.harvard.edu/mta/ASPECT/skawatch3/{}/'
-    curr_prefix = root_prefix.format(currdir)
-    prev_prefix = root_prefix.format(prevdir)
-    next_prefix = root_prefix.format(nextdir)
-    for jw in jobwatches:
-        jw.http_prefix = root_prefix.format(currdir)
-        jw.prev_http_prefix = root_prefix.format(prevdir)
-        jw.next_http_prefix = root_prefix.format(nextdir)
-    index_html = index_template.render(jobwatches=jobwatches,
-                                       rundate=rundate(datenow),
-                                       runtime=runtime(datenow),
-                                       runtime_long=runtime_long(datenow),
-                                       curr_prefix=curr_prefix,
-                                       next_prefix=next_prefix,
-                                       prev_prefix=prev_prefix,
-                                       )
+        if not just_status:
+            # Set an absolute http_prefix for the emailed version of index.html
+            root_prefix = 'http://cxc.harvard.edu/mta/ASPECT/skawatch3/{}/'
+            curr_prefix = root_prefix.format(currdir)
+            prev_prefix = root_prefix.format(prevdir)
+            next_prefix = root_prefix.format(nextdir)
+            index_html = index_template.render(jobwatches=rows,
+                                               rundate=rundate(datenow),
+                                               runtime=runtime(datenow),
+                                               runtime_long=runtime_long(datenow),
+                                               curr_prefix=curr_prefix,
+                                               next_prefix=next_prefix,
+                                               prev_prefix=prev_prefix,
+                                               )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # Raise any error from writing the log pages
+    for future in futures:
+        future.result()
 
     return index_html
 
@@ -295,6 +1098,12 @@ def remove_old_reports(rootdir, date_now, max_age):
         if os.path.exists(outdir):
             shutil.rmtree(outdir)
 
+    # Shared log pages not used by a report within max_age days
+    oldest = DateTime(date_now).unix - max_age * 86400
+    for page_file in glob.glob(os.path.join(rootdir, SHARED_PAGES_DIR, '*.html')):
+        if os.path.getmtime(page_file) < oldest:
+            os.unlink(page_file)
+
 
 def sendmail(recipients, html, datenow, subject=None):
     if subject is None:
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Measure the cost of error / exclude / require patterns against sample logs and
+flag patterns at risk of catastrophic backtracking.
+"""
+
+import os
+import re
+import math
+import time
+import glob
+import argparse
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+import jobwatch.jobwatch
+from jobwatch.jobwatch import compile_bytes_pattern
+
+TEST_LOGS = os.path.join(os.path.dirname(__file__), 'tests', 'logs', '*.log')
+SKAWATCH_CONFIG = os.path.join(os.path.dirname(__file__), 'skawatch.yaml')
+
+REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+UNBOUNDED = sre_constants.MAXREPEAT
+
+# Exponent of search time vs line length above which a pattern is flagged
+MAX_SCALING_EXPONENT = 1.7
+
+
+def _is_unbounded_repeat(op, av):
+    return op in REPEATS and av[1] == UNBOUNDED
+
+
+def _subpatterns(op, av):
+    """Yield the sub-patterns (lists of (op, av)) of one parsed item"""
+    if op in REPEATS:
+        yield av[2]
+    elif op == sre_constants.SUBPATTERN:
+        yield av[-1]
+    elif op == sre_constants.BRANCH:
+        yield from av[1]
+    elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        yield av[1]
+
+
+def _contains_unbounded_repeat(items):
+    for op, av in items:
+        if _is_unbounded_repeat(op, av):
+            return True
+        if any(_contains_unbounded_repeat(sub) for sub in _subpatterns(op, av)):
+            return True
+    return False
+
+
+def _risks(items, risks):
+    prev = None
+    for op, av in items:
+        if _is_unbounded_repeat(op, av):
+            body = list(av[2])
+            if _contains_unbounded_repeat(body):
+                risks.add('nested unbounded quantifier')
+            if any(sub_op == sre_constants.BRANCH or
+                   (sub_op == sre_constants.SUBPATTERN and
+                    any(o == sre_constants.BRANCH for o, _ in sub_av[-1]))
+                   for sub_op, sub_av in body):
+                risks.add('alternation under unbounded quantifier')
+            if prev is not None and _is_unbounded_repeat(*prev) and list(prev[1][2]) == body:
+                risks.add('adjacent identical unbounded quantifiers')
+        for sub in _subpatterns(op, av):
+            _risks(list(sub), risks)
+        prev = (op, av)
+
+
+def pattern_risks(pattern):
+    """
+    Return a sorted list of structural backtracking risks in ``pattern``.
+
+    This is a static check of the parsed regex for the usual causes of
+    super-linear matching: nested unbounded quantifiers like ``(a+)+``,
+    alternation inside an unbounded quantifier like ``(a|ab)*`` and adjacent
+    identical unbounded quantifiers like ``.*.*``.
+    """
+    risks = set()
+    _risks(list(sre_parse.parse(pattern, re.IGNORECASE)), risks)
+    return sorted(risks)
+
+
+def _search_secs(pattern_re, line, min_secs=0.001, repeat=3):
+    # Time per search, repeating searches for at least ``min_secs`` and taking
+    # the best of ``repeat`` such runs so short searches are not just noise
+    best = None
+    for _ in range(repeat):
+        n_search = 0
+        t0 = time.perf_counter()
+        while True:
+            pattern_re.search(line)
+            n_search += 1
+            secs = time.perf_counter() - t0
+            if secs >= min_secs:
+                break
+        secs /= n_search
+        best = secs if best is None else min(best, secs)
+    return best
+
+
+def _fit_exponent(points):
+    # Least squares slope of log(secs) vs log(length)
+    xs = [math.log2(length) for length, _ in points]
+    ys = [math.log2(max(secs, 1e-12)) for _, secs in points]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    return (sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) /
+            sum((x - x_mean) ** 2 for x in xs))
+
+
+def _test_line(text, length):
+    # Line that does not end in a match for typical patterns
+    return (text * (length // len(text) + 1))[:length] + b'!'
+
+
+def scaling_exponent(pattern, max_length=2 ** 16, max_secs=0.01, n_fit=4):
+    """
+    Estimate how search time for ``pattern`` scales with line length.
+
+    Non-matching lines of increasing length are searched, doubling the length
+    until a search takes ``max_secs`` or the line is ``max_length`` long.  The
+    exponent is fit to the search times of the ``n_fit`` longest lines: about
+    1 for linear patterns, 2 for quadratic and so on.  Lengths only grow while
+    searches are fast so this stays cheap for polynomial patterns, but
+    exponential patterns (see ``pattern_risks()``) should not be passed in.
+    """
+    pattern_re = compile_bytes_pattern(pattern)
+    exponent = 0.0
+    for text in (b'warning: 1 a\t_ ', b' ', b'a', b'1'):
+        length = 16
+        points = [(length, _search_secs(pattern_re, _test_line(text, length)))]
+        while length < max_length and (len(points) < 2 or points[-1][1] < max_secs):
+            length *= 2
+            points.append((length, _search_secs(pattern_re, _test_line(text, length))))
+        exponent = max(exponent, _fit_exponent(points[-n_fit:]))
+    return exponent
+
+
+def read_lines(logfiles):
+    """Read the lines of ``logfiles`` as bytes, as they are scanned by JobWatch"""
+    lines = []
+    for logfile in logfiles:
+        with open(logfile, 'rb') as fh:
+            lines.extend(fh.read().splitlines(keepends=True))
+    return lines
+
+
+def benchmark_patterns(patterns, lines, max_line_length=None):
+    """
+    Time each pattern searching each of ``lines``.
+
+    Returns a list of dicts with the pattern, total search time in seconds,
+    number of matching lines, structural risks and the scaling exponent (None
+    for patterns with structural risks), sorted by decreasing time.  Patterns
+    are timed on the sample lines as-is, after truncation to
+    ``max_line_length``.
+    """
+    if max_line_length is None:
+        max_line_length = jobwatch.jobwatch.MAX_LINE_LENGTH
+    results = []
+    for pattern in sorted(set(patterns)):
+        pattern_re = compile_bytes_pattern(pattern)
+        t0 = time.perf_counter()
+        matches = sum(1 for line in lines if pattern_re.search(line[:max_line_length]))
+        secs = time.perf_counter() - t0
+        risks = pattern_risks(pattern)
+        exponent = None if risks else scaling_exponent(pattern)
+        if exponent is not None and exponent > MAX_SCALING_EXPONENT:
+            risks.append('super-linear scaling (time ~ length ** {:.1f})'.format(exponent))
+        results.append({'pattern': pattern, 'secs': secs, 'matches': matches,
+                        'risks': risks, 'scaling': exponent})
+    return sorted(results, key=lambda result: result['secs'], reverse=True)
+
+
+def default_patterns():
+    """Error, exclude and require patterns in the skawatch config"""
+    from jobwatch.plan import load_config, config_patterns
+    return config_patterns(load_config(SKAWATCH_CONFIG))
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description='Benchmark jobwatch log patterns')
+    parser.add_argument('logfiles',
+                        nargs='*',
+                        help='Sample logs (default=jobwatch test logs)')
+    parser.add_argument('--pattern',
+                        action='append',
+                        help='Pattern to check (default=all skawatch patterns)')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_options()
+    patterns = args.pattern or default_patterns()
+    logfiles = args.logfiles or sorted(glob.glob(TEST_LOGS))
+    lines = read_lines(logfiles)
+    print('Benchmarking {} patterns on {} lines from {} logs'.format(
+        len(set(patterns)), len(lines), len(logfiles)))
+
+    results = benchmark_patterns(patterns, lines)
+    print('{:>10s} {:>8s} {:>7s}  {}'.format('Time (ms)', 'Matches', 'Scaling', 'Pattern'))
+    for result in results:
+        scaling = '--' if result['scaling'] is None else '{:.1f}'.format(result['scaling'])
+        print('{:10.2f} {:8d} {:>7s}  {!r}'.format(
+            result['secs'] * 1000, result['matches'], scaling, result['pattern']))
+        for risk in result['risks']:
+            print('{:>28s}  WARNING: {}'.format('', risk))
+
+    risky = [result for result in results if result['risks']]
+    if risky:
+        print('{} pattern(s) at risk of super-linear backtracking'.format(len(risky)))
+    return 1 if risky else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,307 @@
+"""
+Watch definitions loaded from a YAML or TOML config file and compiled into a
+deduplicated watch plan.
+"""
+
+import os
+import re
+import glob
+import json
+import hashlib
+import inspect
+import warnings
+
+import yaml
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    tomllib = None
+
+from jobwatch import __version__
+from jobwatch.jobwatch import (compile_bytes_pattern, copy_errs, load_json_state,
+                               write_json_atomic)
+from jobwatch.patterns import pattern_risks
+
+# Watch arguments that are lists of patterns or the name of an error set
+PATTERN_ARGS = ('errors', 'exclude_errors', 'requires')
+
+# Watch arguments that identify the resource probed by a watch, in order of
+# precedence, with the kind of resource
+RESOURCE_ARGS = (('url', 'url'),
+                 ('dbfile', 'database'),
+                 ('logdir', 'directory'),
+                 ('ifotbasename', 'directory'),
+                 ('filename', 'file'),
+                 ('basename', 'file'))
+
+
+def parse_config(text, filename):
+    if filename.endswith('.toml'):
+        if tomllib is None:
+            raise ValueError('TOML config {} requires Python >= 3.11'.format(filename))
+        return tomllib.loads(text.decode('utf-8'))
+    return yaml.safe_load(text)
+
+
+def load_config(filename):
+    with open(filename, 'rb') as fh:
+        return parse_config(fh.read(), filename)
+
+
+def resolve_error_sets(error_sets):
+    """
+    Resolve the ``error_sets`` config section to a dict of pattern lists.
+
+    Each error set is either a list of patterns or a dict with a ``base`` set
+    name (or list of names) and lists of patterns to ``remove`` and ``add``,
+    as in ``copy_errs()``.
+    """
+    resolved = {}
+
+    def resolve(name, seen):
+        if name not in error_sets:
+            raise ValueError('unknown error set {!r}'.format(name))
+        if name in seen:
+            raise ValueError('error set {!r} refers to itself'.format(name))
+        if name not in resolved:
+            spec = error_sets[name]
+            if isinstance(spec, dict):
+                bases = spec.get('base', [])
+                if isinstance(bases, str):
+                    bases = [bases]
+                patterns = set()
+                for base in bases:
+                    patterns.update(resolve(base, seen + (name,)))
+                resolved[name] = sorted(copy_errs(patterns,
+                                                  spec.get('remove', []),
+                                                  spec.get('add', [])))
+            else:
+                # Keep the given order but drop duplicates
+                resolved[name] = list(dict.fromkeys(spec))
+        return resolved[name]
+
+    for name in error_sets:
+        resolve(name, ())
+    return resolved
+
+
+def config_watches(config, group=None):
+    """
+    Return the list of watch definitions in ``config`` for ``group``.
+    """
+    watches = config.get('watches', [])
+    if isinstance(watches, dict):
+        if group not in watches:
+            raise ValueError('no watch group {!r} in config (available: {})'.format(
+                group, ', '.join(sorted(watches))))
+        watches = watches[group]
+    elif group is not None:
+        raise ValueError('config has no watch groups but group {!r} was given'.format(group))
+    return watches
+
+
+def config_patterns(config):
+    """
+    Return the set of all patterns in error sets and watches in ``config``.
+    """
+    error_sets = resolve_error_sets(config.get('error_sets', {}))
+    patterns = set()
+    for patterns_list in error_sets.values():
+        patterns.update(patterns_list)
+    watches = config.get('watches', [])
+    if isinstance(watches, dict):
+        watches = [watch for group in watches.values() for watch in group]
+    for watch in watches:
+        for arg in PATTERN_ARGS:
+            if arg in watch:
+                patterns.update(_resolve_patterns(watch[arg], error_sets))
+    return patterns
+
+
+def _resolve_patterns(value, error_sets):
+    if isinstance(value, str):
+        # A single string is an error set name or else a single pattern
+        return list(error_sets.get(value, [value]))
+    return list(value)
+
+
+def watch_resource(args):
+    """
+    Return the (kind, location) of the resource probed by a watch with ``args``.
+    """
+    for arg, kind in RESOURCE_ARGS:
+        if args.get(arg):
+            location = args[arg]
+            if kind != 'url' and not os.path.isabs(location):
+                # Relative to a task directory
+                location = 'task:{}/{}'.format(args.get('task'), location)
+            return kind, location
+    return 'task', 'task:{}'.format(args.get('task'))
+
+
+def _resource_group(resource):
+    # Watches on files in the same directory go together
+    kind, location = resource
+    if kind == 'file':
+        return 'file', os.path.dirname(location)
+    return kind, location
+
+
+class WatchPlan(object):
+    """
+    Compiled list of watch definitions.
+
+    ``watches`` is the list of unique watch definitions in config order.  Each
+    is a dict with the watch ``class`` name, keyword ``args`` and the
+    ``resource`` (kind, location) it probes.  ``order`` is the list of indices
+    into ``watches`` in evaluation order, with watches on the same resource
+    (or directory) next to each other.
+    """
+    def __init__(self, watches, order, n_duplicates=0):
+        self.watches = watches
+        self.order = order
+        self.n_duplicates = n_duplicates
+
+    @classmethod
+    def compile(cls, config, classes, group=None):
+        """
+        Validate the watch definitions in ``config`` and compile them into a plan.
+
+        ``classes`` is a dict of the watch classes that can be used in the
+        config, by name.  Invalid definitions raise ValueError, and patterns
+        at risk of catastrophic backtracking give a warning.
+        """
+        error_sets = resolve_error_sets(config.get('error_sets', {}))
+        watches = []
+        keys = set()
+        n_duplicates = 0
+        for i_watch, watch in enumerate(config_watches(config, group)):
+            args = dict(watch)
+            class_name = args.pop('class', None)
+            if class_name not in classes:
+                raise ValueError('watch {}: unknown watch class {!r}'.format(i_watch, class_name))
+            for arg in PATTERN_ARGS:
+                if arg in args:
+                    args[arg] = _resolve_patterns(args[arg], error_sets)
+                    for pattern in args[arg]:
+                        try:
+                            compile_bytes_pattern(pattern)
+                        except re.error as err:
+                            raise ValueError('watch {}: bad pattern {!r}: {}'.format(
+                                i_watch, pattern, err))
+                        for risk in pattern_risks(pattern):
+                            warnings.warn('watch {}: pattern {!r}: {}'.format(
+                                i_watch, pattern, risk))
+            try:
+                inspect.signature(classes[class_name]).bind(**args)
+            except TypeError as err:
+                raise ValueError('watch {} ({}): {}'.format(i_watch, class_name, err))
+
+            key = json.dumps([class_name, args], sort_keys=True)
+            if key in keys:
+                n_duplicates += 1
+                continue
+            keys.add(key)
+            watches.append({'class': class_name,
+                            'args': args,
+                            'resource': list(watch_resource(args))})
+
+        order = sorted(range(len(watches)),
+                       key=lambda idx: _resource_group(watches[idx]['resource']))
+        return cls(watches, order, n_duplicates)
+
+    def as_dict(self):
+        return {'watches': self.watches,
+                'order': self.order,
+                'n_duplicates': self.n_duplicates}
+
+    @classmethod
+    def from_dict(cls, plan):
+        return cls(plan['watches'], plan['order'], plan['n_duplicates'])
+
+    def patterns(self):
+        return set(pattern for watch in self.watches
+                   for arg in PATTERN_ARGS
+                   for pattern in watch['args'].get(arg, ()))
+
+    def compile_patterns(self):
+        for pattern in self.patterns():
+            compile_bytes_pattern(pattern)
+
+    def evaluate(self, classes, tasks=None, replace=None):
+        """
+        Create (and thereby check) the watches in the plan and return their results.
+
+        Watches are created in resource order and each is reduced to its
+        WatchResult as soon as it is checked, so log contents are not kept.
+        Results are returned in config order.  If ``tasks`` is given only
+        watches with a task matching that regex are created.
+
+        ``replace`` is an optional dict of results by (type, task), e.g. from
+        agent shards.  Watches whose class ``type`` and task are in it are not
+        created, and the results for that key take the place of the first one.
+        """
+        replace = replace or {}
+        results = {}
+        first_idx = {}
+        for idx in self.order:
+            watch = self.watches[idx]
+            if tasks and not re.search(tasks, watch['args']['task']):
+                continue
+            key = (getattr(classes[watch['class']], 'type', 'Job'), watch['args']['task'])
+            if key in replace:
+                first_idx[key] = min(idx, first_idx.get(key, idx))
+                continue
+            results[idx] = [classes[watch['class']](**watch['args']).result()]
+        for key, idx in first_idx.items():
+            results[idx] = replace[key]
+        return [result for idx in sorted(results) for result in results[idx]]
+
+
+def plan_digest(text, classes, group=None):
+    """
+    Hash of config ``text``, ``group``, the package version and the signatures
+    of the watch ``classes``, which together determine the compiled plan.
+    """
+    key = [__version__, repr(group)]
+    key.extend('{}{}'.format(name, inspect.signature(classes[name])) for name in sorted(classes))
+    return hashlib.sha1(text + '\n'.join(key).encode('utf-8')).hexdigest()
+
+
+def load_plan(filename, classes, group=None, cache_dir=None):
+    """
+    Load the watch plan for ``filename`` (and ``group``).
+
+    If ``cache_dir`` is given the compiled plan is saved there, keyed by
+    ``plan_digest()``, and later loads of the same config use the cached plan
+    without parsing and validating the config.  Plans cached for other
+    digests are removed when a new one is saved.
+    """
+    with open(filename, 'rb') as fh:
+        text = fh.read()
+    digest = plan_digest(text, classes, group)
+
+    plan = None
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'watch_plan_{}.json'.format(digest[:16]))
+        cached = load_json_state(cache_file)
+        if cached:
+            try:
+                plan = WatchPlan.from_dict(cached)
+            except KeyError:
+                plan = None
+        if plan is not None and any(watch['class'] not in classes for watch in plan.watches):
+            plan = None
+
+    if plan is None:
+        plan = WatchPlan.compile(parse_config(text, filename), classes, group)
+        if cache_file is not None:
+            write_json_atomic(cache_file, plan.as_dict())
+            for old_file in glob.glob(os.path.join(cache_dir, 'watch_plan_*.json')):
+                if old_file != cache_file:
+                    os.unlink(old_file)
+
+    plan.compile_patterns()
+    return plan
@@ -0,0 +1,111 @@
+"""
+Optional profiling of skawatch runs with cProfile and tracemalloc.
+"""
+
+import os
+import time
+import pstats
+import cProfile
+import tracemalloc
+from collections import defaultdict
+
+
+class RunProfiler(object):
+    """
+    Profile watch evaluation and report generation for one run.
+
+    Call ``start()`` before the watches are created and ``stop()`` after the
+    report is made, then ``write()`` to save the results in the report
+    directory as ``<name>.pstats``, ``<name>_memory.txt`` and
+    ``<name>_watches.txt``.  Nothing is done unless ``profile`` or
+    ``trace_memory`` is set.
+    """
+    def __init__(self, profile=False, trace_memory=False, top=25):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.top = top
+        self.profiler = None
+        self.snapshot = None
+        self.peak_memory = None
+
+    @property
+    def enabled(self):
+        return self.profile or self.trace_memory
+
+    def report_workers(self, workers):
+        """
+        Number of threads to write report pages with: cProfile only profiles
+        the thread that enabled it, so pages are written in this thread when
+        profiling.
+        """
+        return 1 if self.profile else workers
+
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.t0 = time.perf_counter()
+
+    def stop(self):
+        self.run_secs = time.perf_counter() - self.t0
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.trace_memory:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def write(self, outdir, jobwatches, name='skawatch'):
+        """
+        Write profile results into ``outdir`` and return the list of files written.
+        """
+        if not self.enabled:
+            return []
+        os.makedirs(outdir, exist_ok=True)
+        outfiles = []
+
+        if self.profiler is not None:
+            outfile = os.path.join(outdir, '{}.pstats'.format(name))
+            self.profiler.dump_stats(outfile)
+            outfiles.append(outfile)
+            with open(os.path.join(outdir, '{}_profile.txt'.format(name)), 'w') as fh:
+                stats = pstats.Stats(self.profiler, stream=fh)
+                stats.sort_stats('cumulative').print_stats(self.top)
+            outfiles.append(fh.name)
+
+        if self.snapshot is not None:
+            outfile = os.path.join(outdir, '{}_memory.txt'.format(name))
+            with open(outfile, 'w') as fh:
+                print('Peak traced memory: {:.1f} MB'.format(self.peak_memory / 1e6), file=fh)
+                print('Top {} allocations by line:'.format(self.top), file=fh)
+                for stat in self.snapshot.statistics('lineno')[:self.top]:
+                    print(stat, file=fh)
+            outfiles.append(outfile)
+
+        outfile = os.path.join(outdir, '{}_watches.txt'.format(name))
+        with open(outfile, 'w') as fh:
+            print('Total run time: {:.3f} s'.format(self.run_secs), file=fh)
+            print(watch_type_breakdown(jobwatches), file=fh)
+        outfiles.append(outfile)
+
+        return outfiles
+
+
+def watch_type_breakdown(jobwatches):
+    """
+    Return a text table of the number of watches and check time per watch type.
+    """
+    counts = defaultdict(int)
+    secs = defaultdict(float)
+    for jw in jobwatches:
+        watch_type = getattr(jw, 'type', 'Job')
+        counts[watch_type] += 1
+        secs[watch_type] += getattr(jw, 'check_secs', 0.0)
+
+    lines = ['{:<24s} {:>6s} {:>10s}'.format('Type', 'Count', 'Check (s)')]
+    for watch_type in sorted(secs, key=secs.get, reverse=True):
+        lines.append('{:<24s} {:>6d} {:>10.3f}'.format(
+            watch_type, counts[watch_type], secs[watch_type]))
+    return '\n'.join(lines)
@@ -0,0 +1,60 @@
+import os
+import shutil
+
+import jobwatch
+from jobwatch import error_index
+
+os.chdir(os.path.dirname(__file__))
+
+
+def test_tokenize():
+    assert error_index.tokenize('HTTP Error 504: Gateway Time-out error') == [
+        '504', 'error', 'gateway', 'http', 'out', 'time']
+
+
+def test_update_index(tmpdir):
+    rootdir = str(tmpdir)
+    jws = [jobwatch.JobWatch('errors', 'logs/errors.log', errors=('warn', 'error'))]
+    rows = jobwatch.report_rows(jws, page_lines=50)
+
+    days = []
+    for datenow in ('2026:290:12:00:00', '2026:291:12:00:00', '2026:291:13:00:00'):
+        outdir = jobwatch.report_outdir(rootdir, datenow)
+        os.makedirs(outdir, exist_ok=True)
+        days.append(os.path.basename(outdir))
+        error_index.update_index(rows, rootdir, datenow)
+    assert os.path.exists(os.path.join(rootdir, 'search.html'))
+
+    # A re-run on the same day replaces that day's hits
+    results = error_index.search(rootdir, 'WARN test message 3')
+    assert [result['day'] for result in results] == [days[1], days[0]]
+    assert results[0]['i_line'] == 60
+    assert results[0]['href'] == '{}/log0_1.html#error60'.format(days[1])
+
+    assert len(error_index.search(rootdir, 'warn')) < len(error_index.search(rootdir, ''))
+    assert error_index.search(rootdir, 'warn', task='^other$') == []
+    assert error_index.search(rootdir, 'no such words') == []
+
+    # Newest day first, then by task and line
+    results = error_index.search(rootdir, '')
+    keys = [(result['day'], result['task'], result['i_line']) for result in results]
+    assert keys == sorted(keys, key=lambda key: (-int(key[0]), key[1], key[2]))
+
+    # Hits for days removed from the report root go with them
+    shutil.rmtree(os.path.join(rootdir, days[0]))
+    error_index.prune_index(rootdir)
+    results = error_index.search(rootdir, 'warn test message 3')
+    assert [result['day'] for result in results] == [days[1]]
+
+
+def test_corrupt_index(tmpdir):
+    rootdir = str(tmpdir)
+    with open(os.path.join(rootdir, error_index.INDEX_FILE), 'w') as fh:
+        fh.write('{"errors": [["task", "warn", "warn')
+    assert error_index.ErrorIndex(rootdir).errors == {}
+
+    jws = [jobwatch.JobWatch('errors', 'logs/errors.log', errors=('warn', 'error'))]
+    rows = jobwatch.report_rows(jws, page_lines=50)
+    os.makedirs(jobwatch.report_outdir(rootdir, '2026:290:12:00:00'), exist_ok=True)
+    error_index.update_index(rows, rootdir, '2026:290:12:00:00')
+    assert len(error_index.search(rootdir, 'warn test message 3')) == 1
@@ -1,5 +1,10 @@
 import os
+import glob
+import json
 import time
+import multiprocessing
+
+import pytest
 
 import jobwatch
 
@@ -90,8 +95,7 @@ def test_filewatch(tmpdir):
                'trending/pitch_hist_recent.png')
     Watch = jobwatch.FileWatch
     jws = [Watch(task='obc_rate_noise', filename=jobfile, maxage=50)]
-    jobwatch.set_report_attrs(jws)
-    jobwatch.make_html_report(jws, rootdir=os.path.join(tmpdir, 'out_file'))
+    jobwatch.make_html_report(jobwatch.report_rows(jws), rootdir=os.path.join(tmpdir, 'out_file'))
 
 
 def test_make_html_report(tmpdir):
@@ -107,5 +111,399 @@ def test_make_html_report(tmpdir):
                                        'APPending')),
            SkaJobWatch(task='eng_archive'),
            SkaJobWatch(task='astromon')]
-    jobwatch.set_report_attrs(jws)
-    jobwatch.make_html_report(jws, rootdir=os.path.join(tmpdir, 'out_report'))
+    rows = jobwatch.report_rows(jws)
+    jobwatch.make_html_report(rows, rootdir=os.path.join(tmpdir, 'out_report'))
+
+
+def test_make_html_report_workers(tmpdir):
+    jws = [jobwatch.JobWatch('errors {}'.format(i), 'logs/errors.log', errors=('warn', 'error'))
+           for i in range(6)]
+    rows = jobwatch.report_rows(jws, page_lines=20)
+    pages = {}
+    for workers in (1, 4):
+        outdir = os.path.join(tmpdir, 'out_workers_{}'.format(workers), 'status')
+        jobwatch.make_html_report(rows, rootdir=os.path.dirname(outdir),
+                                  just_status=True, workers=workers)
+        pages[workers] = {name: open(os.path.join(outdir, name)).read()
+                          for name in os.listdir(outdir) if name.startswith('log')}
+    assert len(pages[4]) == 6 * (1 + len(rows[0]['log_pages']))
+    assert pages[1] == pages[4]
+
+
+def test_dir_stats(tmpdir):
+    for name in ('a.log', 'b.log', 'b.log.OK'):
+        tmpdir.join(name).write('hello')
+    stats = jobwatch.DirStats()
+    a_log = str(tmpdir.join('a.log'))
+    b_log = str(tmpdir.join('b.log'))
+
+    # First file in the directory is stat'ed directly, the second triggers a scan
+    assert stats.exists(a_log)
+    assert str(tmpdir) not in stats._entries
+    assert stats.exists(b_log + '.OK')
+    assert set(stats.entries(str(tmpdir))) == {'a.log', 'b.log', 'b.log.OK'}
+    assert stats.stat(b_log).st_mtime == os.path.getmtime(b_log)
+    assert not stats.exists(str(tmpdir.join('c.log')))
+
+
+def test_dir_stats_jobwatch():
+    stats = jobwatch.DirStats()
+    jobwatch.jobwatch.STAT_CACHE = stats
+    try:
+        jws = [jobwatch.JobWatch('errors', 'logs/errors.log', errors=('warn', 'error')),
+               jobwatch.JobWatch('exists', 'logs/doesnt_exist')]
+    finally:
+        jobwatch.jobwatch.STAT_CACHE = None
+    assert jws[0].exists is True
+    assert len(jws[0].found_errors) == 5
+    assert jws[0].filetime == os.path.getmtime('logs/errors.log')
+    assert jws[1].exists is False
+    # Two files in logs/ so the directory listing was used
+    assert os.path.abspath('logs') in stats._entries
+
+
+def test_latest_file(tmpdir):
+    assert jobwatch.latest_file(str(tmpdir)) is None
+    assert jobwatch.latest_file(str(tmpdir.join('missing'))) is None
+
+    for name in ('2024001.txt', '2024003.txt', '2024002.txt', '.hidden', 'zz.log'):
+        tmpdir.join(name).write('')
+    assert jobwatch.latest_file(str(tmpdir)) == str(tmpdir.join('zz.log'))
+    assert jobwatch.latest_file(str(tmpdir), '*.txt') == str(tmpdir.join('2024003.txt'))
+
+
+def test_mtime_cache(tmpdir):
+    cache_file = str(tmpdir.join('cache.json'))
+    path = str(tmpdir.join('data'))
+    tmpdir.join('data').write('')
+    calls = []
+
+    def func():
+        calls.append(1)
+        return len(calls)
+
+    cache = jobwatch.MtimeCache(cache_file)
+    assert cache.get('key', path, func) == 1
+    assert cache.get('key', path, func) == 1
+    cache.save()
+
+    # Reloaded cache is still valid until the mtime changes
+    cache = jobwatch.MtimeCache(cache_file)
+    assert cache.get('key', path, func) == 1
+    os.utime(path, (0, 0))
+    assert cache.get('key', path, func) == 2
+    assert len(calls) == 2
+
+
+def test_json_state(tmpdir):
+    filename = str(tmpdir.join('state', 'state.json'))
+    assert jobwatch.load_json_state(filename) == {}
+    jobwatch.write_json_atomic(filename, {'a': [1, 2]})
+    assert jobwatch.load_json_state(filename) == {'a': [1, 2]}
+    assert os.listdir(str(tmpdir.join('state'))) == ['state.json']
+
+    # A corrupt state file starts over
+    tmpdir.join('state', 'state.json').write('{"a": [1,')
+    assert jobwatch.load_json_state(filename, {'b': 1}) == {'b': 1}
+    assert jobwatch.MtimeCache(filename)._cache == {}
+
+
+class LastLineProbe(jobwatch.Probe):
+    calls = 0
+
+    def last_time(self):
+        LastLineProbe.calls += 1
+        with open(self.filename) as fh:
+            return float(fh.readlines()[-1])
+
+
+def test_probe(tmpdir):
+    datafile = tmpdir.join('data.txt')
+    one_day_ago = time.time() - 86400
+    datafile.write('0\n{}\n'.format(one_day_ago))
+    jw = jobwatch.JobWatch('probe', str(datafile), maxage=0.5,
+                           probe=LastLineProbe(str(datafile)))
+    assert jw.filetime == one_day_ago
+    assert jw.stale is True
+
+    # Unchanged backing file so the probe result comes from the cache
+    jw = jobwatch.JobWatch('probe', str(datafile), maxage=2,
+                           probe=LastLineProbe(str(datafile)))
+    assert jw.stale is False
+    assert LastLineProbe.calls == 1
+
+    # A probe without last_time() fails when it is created
+    class NoTimeProbe(jobwatch.Probe):
+        pass
+
+    with pytest.raises(TypeError):
+        NoTimeProbe(str(datafile))
+
+
+def run_agent(task, filename, spooldir):
+    jws = [jobwatch.JobWatch(task, filename, errors=('warn', 'error'))]
+    jobwatch.write_shard(jws, spooldir, agent=task)
+
+
+def test_agent_shards(tmpdir):
+    spooldir = str(tmpdir.join('spool'))
+    procs = [multiprocessing.Process(target=run_agent, args=(task, filename, spooldir))
+             for task, filename in (('errors', 'logs/errors.log'),
+                                    ('stale', 'logs/stale.log'),
+                                    ('exists', 'logs/doesnt_exist'))]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+
+    # Make one agent look like it stopped two days ago
+    two_days_ago = time.time() - 2 * 86400
+    os.utime(os.path.join(spooldir, 'stale.json'), (two_days_ago, two_days_ago))
+
+    shard_jws = jobwatch.read_shards(spooldir, maxage=1)
+    local_jws = [jobwatch.JobWatch('errors', 'logs/doesnt_exist'),
+                 jobwatch.JobWatch('local', 'logs/stale.log')]
+    jws = jobwatch.merge_shards(local_jws, shard_jws)
+    assert [jw.task for jw in jws] == ['errors', 'local', 'exists', 'stale',
+                                       'agent errors', 'agent exists', 'agent stale']
+    assert jws[0].exists is True
+    assert len(jws[0].found_errors) == 5
+    assert jws[0].found_errors[2] == (60, 'warn test message 3\n', 'warn')
+    assert jws[2].exists is False
+    assert [jw.stale for jw in jws[-3:]] == [False, False, True]
+
+    jobwatch.make_html_report(jobwatch.report_rows(jws),
+                              rootdir=os.path.join(tmpdir, 'out_agents'))
+
+    # Unreadable shards are reported as NOT OK agents without losing the others
+    with open(os.path.join(spooldir, 'empty.json'), 'w'):
+        pass
+    with open(os.path.join(spooldir, 'old.json'), 'w') as fh:
+        json.dump({'agent': 'old', 'watches': [{'task': 'old'}]}, fh)
+    shard_jws = jobwatch.read_shards(spooldir, maxage=1)
+    assert [jw.task for jw in shard_jws] == ['errors', 'exists', 'stale', 'agent empty',
+                                             'agent errors', 'agent exists', 'agent old',
+                                             'agent stale']
+    rows = jobwatch.report_rows(shard_jws)
+    assert [row['ok'] for row in rows[3:]] == [False, True, True, False, False]
+    assert 'Unreadable shard' in shard_jws[3].found_errors[0][1]
+
+
+def test_error_windows():
+    lines = ['line {}\n'.format(i) for i in range(30)]
+    found_errors = [(3, lines[3], 'error'), (5, lines[5], 'error'), (20, lines[20], 'error')]
+    windows = jobwatch.error_windows(lines, found_errors, context_lines=2)
+    assert [[i_line for i_line, _, _ in window] for window in windows] == [
+        [1, 2, 3, 4, 5, 6, 7], [18, 19, 20, 21, 22]]
+    assert [is_error for _, _, is_error in windows[1]] == [False, False, True, False, False]
+
+    # No log lines available (e.g. an agent result) so only the error lines remain
+    windows = jobwatch.error_windows([], found_errors, context_lines=2)
+    assert windows == [[(3, 'line 3\n', True), (5, 'line 5\n', True)],
+                       [(20, 'line 20\n', True)]]
+
+
+def test_log_pages(tmpdir):
+    jws = [jobwatch.JobWatch('errors', 'logs/errors.log', errors=('warn', 'error'))]
+    rows = jobwatch.report_rows(jws, context_lines=1, page_lines=50)
+    n_lines = len(jws[0].filelines)
+    assert len(rows[0]['log_pages']) == (n_lines + 49) // 50
+    assert len(rows[0]['error_windows']) <= len(jws[0].found_errors)
+
+    outdir = os.path.join(tmpdir, 'out_pages')
+    jobwatch.make_html_report(rows, rootdir=outdir, just_status=True)
+    for page_name in rows[0]['log_pages']:
+        assert os.path.exists(os.path.join(outdir, 'status', page_name))
+    log_html = open(os.path.join(outdir, 'status', 'log0.html')).read()
+    assert '<a name=error60>' in log_html
+    assert 'log0_1.html#error60' in log_html
+
+
+def test_shared_log_pages(tmpdir):
+    logfile = tmpdir.join('job.log')
+    logfile.write(''.join('line {}\n'.format(i) for i in range(30)))
+    rootdir = str(tmpdir.join('out_shared'))
+
+    def make_report(datenow):
+        jws = [jobwatch.JobWatch('job', str(logfile), errors=('error',)),
+               jobwatch.JobWatch('errors', 'logs/errors.log', errors=('warn', 'error'))]
+        rows = jobwatch.report_rows(jws, page_lines=20)
+        jobwatch.make_html_report(rows, rootdir, datenow, workers=1)
+        return rows
+
+    # Pages of a log without errors go in the shared directory, pages of a
+    # log with errors in the report directory
+    rows = make_report('2026:290:12:00:00')
+    assert [os.path.dirname(page) for page in rows[0]['log_pages']] == ['../logs', '../logs']
+    assert rows[1]['log_pages'][0] == 'log1_0.html'
+    page_files = sorted(glob.glob(os.path.join(rootdir, 'logs', '*.html')))
+    assert len(page_files) == 2
+    assert 'line 25' in open(page_files[1]).read()
+    os.utime(page_files[0], (0, 0))
+
+    # An unchanged log is not paged again
+    rows = make_report('2026:291:12:00:00')
+    assert sorted(glob.glob(os.path.join(rootdir, 'logs', '*.html'))) == page_files
+    assert os.path.getmtime(page_files[0]) > 0
+    log_html = open(os.path.join(jobwatch.report_outdir(rootdir, '2026:291:12:00:00'),
+                                 'log0.html')).read()
+    assert rows[0]['log_pages'][1] in log_html
+
+    # A changed log is, and pages no report has used for max_age days are removed
+    logfile.write('line 30\n', mode='a')
+    make_report('2026:292:12:00:00')
+    assert len(glob.glob(os.path.join(rootdir, 'logs', '*.html'))) == 4
+    for page_file in page_files:
+        os.utime(page_file, (0, 0))
+    jobwatch.remove_old_reports(rootdir, '2026:292:12:00:00', max_age=30)
+    assert len(glob.glob(os.path.join(rootdir, 'logs', '*.html'))) == 2
+
+
+def test_watch_result(tmpdir):
+    jw = jobwatch.JobWatch('errors', 'logs/errors.log', errors=('warn', 'error'))
+    result = jw.result()
+    assert not hasattr(result, '__dict__')
+    assert result.n_lines == len(jw.filelines)
+    assert result.found_errors == jw.found_errors
+    assert list(result.iter_lines()) == jw.filelines
+
+    record = jobwatch.WatchResult.from_record(jobwatch.watch_record(result))
+    assert record.found_errors == result.found_errors
+    assert list(record.iter_lines()) == []
+
+    results = [result, jobwatch.FileWatch('stale', filename='logs/stale.log').result()]
+    rows = jobwatch.report_rows(results, context_lines=1, page_lines=50)
+    assert len(rows[0]['log_pages']) == (result.n_lines + 49) // 50
+    assert rows[1]['log_pages'] == []
+    # Report state is kept in the rows, not in the results
+    assert rows[0]['result'] is result
+    assert not hasattr(result, 'log_pages')
+
+    outdir = os.path.join(tmpdir, 'out_results')
+    jobwatch.make_html_report(rows, rootdir=outdir, just_status=True)
+    page_html = open(os.path.join(outdir, 'status', 'log0_1.html')).read()
+    assert '<a name=error60><span class="red">60: warn test message 3</span></a>' in page_html
+
+
+def test_watch_result_changed_log(tmpdir):
+    logfile = tmpdir.join('job.log')
+    logfile.write('start\nerror one\nend\n')
+    result = jobwatch.JobWatch('job', str(logfile), errors=('error',)).result()
+    assert result.log_size == len('start\nerror one\nend\n')
+
+    # Lines appended after the check are not read for the report
+    logfile.write('start\nerror one\nend\nerror two\n')
+    assert list(result.iter_lines()) == ['start\n', 'error one\n', 'end\n']
+
+    # A log that shrank (e.g. was rotated) is not read, and the report only
+    # shows the error lines that were found
+    logfile.write('new\n')
+    assert list(result.iter_lines()) == []
+    rows = jobwatch.report_rows([result], context_lines=1)
+    assert rows[0]['error_windows'] == [[(1, 'error one\n', True)]]
+
+
+def test_bad_encoding(tmpdir):
+    logfile = tmpdir.join('latin1.log')
+    logfile.write_binary(b'caf\xe9 started\n\x00\xff\xfe binary\nERROR in caf\xe9\nall done\n')
+    jw = jobwatch.JobWatch('latin1', str(logfile), errors=('error', 'caf.? start'))
+    assert jw.found_errors == [(0, 'caf\\xe9 started\n', 'caf.? start'),
+                               (2, 'ERROR in caf\\xe9\n', 'error')]
+    assert jobwatch.compile_bytes_pattern(jobwatch.compile_pattern('error')).search(b'ERROR')
+
+    rows = jobwatch.report_rows([jw.result()], context_lines=1)
+    assert [line for _, line, _ in rows[0]['error_windows'][0]][1] == '\x00\\xff\\xfe binary\n'
+    outdir = os.path.join(tmpdir, 'out_latin1')
+    jobwatch.make_html_report(rows, rootdir=outdir, just_status=True)
+    assert 'ERROR in caf\\xe9' in open(os.path.join(outdir, 'status', 'log0_0.html')).read()
+
+
+def test_carriage_returns(tmpdir):
+    logfile = tmpdir.join('progress.log')
+    logfile.write_binary(b'sending\r 10%\r 100% error here\nwindows error\r\ndone\n')
+    jw = jobwatch.JobWatch('progress', str(logfile), errors=('error',))
+    # Split as in text mode
+    assert jw.rawlines[:3] == [b'sending\r', b' 10%\r', b' 100% error here\n']
+    assert jw.n_lines == 5
+    assert [i_line for i_line, _, _ in jw.found_errors] == [2, 3]
+    assert list(jw.result().iter_rawlines()) == jw.rawlines
+
+
+def test_scheduler(tmpdir):
+    logfile = tmpdir.join('job.log')
+    logfile.write('all good\n')
+    two_hours_ago = time.time() - 2 * 3600
+    os.utime(str(logfile), (two_hours_ago, two_hours_ago))
+    schedule_file = str(tmpdir.join('schedule.json'))
+
+    jobwatch.jobwatch.SCHEDULER = jobwatch.Scheduler(schedule_file)
+    try:
+        jw = jobwatch.JobWatch('job', str(logfile), errors=('error',), maxage=1)
+        assert not hasattr(jw, 'carried_from')
+        jobwatch.jobwatch.SCHEDULER.save()
+
+        # Updated 2 hours ago with maxage of 1 day so not due until 12 hours after
+        # the update, and the unchanged file is not read again
+        jobwatch.jobwatch.SCHEDULER = jobwatch.Scheduler(schedule_file)
+        jw = jobwatch.JobWatch('job', str(logfile), errors=('error',), maxage=1)
+        assert jw.carried_from
+        assert jw.found_errors == []
+        assert jw.stale is False
+        assert abs(jw.age - 2 / 24) < 0.01
+        # The unchanged log can still be shown in the report
+        result = jw.result()
+        assert (result.log_filename, result.n_lines) == (str(logfile), 1)
+        assert list(result.iter_lines()) == ['all good\n']
+        assert len(jobwatch.report_rows([result])[0]['log_pages']) == 1
+
+        # Changed patterns are checked again
+        jobwatch.jobwatch.SCHEDULER = jobwatch.Scheduler(schedule_file)
+        jw = jobwatch.JobWatch('job', str(logfile), errors=('error', 'good'), maxage=1)
+        assert not hasattr(jw, 'carried_from')
+        assert len(jw.found_errors) == 1
+
+        # Not skipped with a full check or a maxage that makes the watch due
+        jobwatch.jobwatch.SCHEDULER = jobwatch.Scheduler(schedule_file, full_check=True)
+        jw = jobwatch.JobWatch('job', str(logfile), errors=('error',), maxage=1)
+        assert not hasattr(jw, 'carried_from')
+        jobwatch.jobwatch.SCHEDULER = jobwatch.Scheduler(schedule_file)
+        jw = jobwatch.JobWatch('job', str(logfile), errors=('error',), maxage=0.1)
+        assert not hasattr(jw, 'carried_from')
+
+        # A changed file is checked again even though it is not due
+        logfile.write('error\n')
+        jobwatch.jobwatch.SCHEDULER = jobwatch.Scheduler(schedule_file)
+        jw = jobwatch.JobWatch('job', str(logfile), errors=('error',), maxage=1)
+        assert not hasattr(jw, 'carried_from')
+        assert len(jw.found_errors) == 1
+
+        # Only watches checked or carried forward in a run are saved
+        other_log = tmpdir.join('other.log')
+        other_log.write('all good\n')
+        jobwatch.jobwatch.SCHEDULER = jobwatch.Scheduler(schedule_file)
+        jw = jobwatch.JobWatch('job', str(other_log), errors=('error',), maxage=1)
+        jobwatch.jobwatch.SCHEDULER.save()
+        with open(schedule_file, 'r') as fh:
+            assert list(json.load(fh)) == [jobwatch.Scheduler.key(jw)]
+    finally:
+        jobwatch.jobwatch.SCHEDULER = None
+
+
+def test_scheduler_intervals(tmpdir):
+    logfile = tmpdir.join('job.log')
+    logfile.write('all good\n')
+    scheduler = jobwatch.Scheduler(full_check=True)
+    jobwatch.jobwatch.SCHEDULER = scheduler
+    try:
+        for hours_ago in (5, 3):
+            mtime = time.time() - hours_ago * 3600
+            os.utime(str(logfile), (mtime, mtime))
+            jw = jobwatch.JobWatch('job', str(logfile), maxage=10)
+    finally:
+        jobwatch.jobwatch.SCHEDULER = None
+    state = scheduler._state[scheduler.key(jw)]
+    assert len(state['intervals']) == 1
+    assert abs(state['intervals'][0] - 2 / 24) < 0.001
+    # Observed 2 hour cadence so due 1 hour after the last update, i.e. now
+    assert scheduler.next_check(jw) < time.time()
@@ -0,0 +1,42 @@
+import os
+import glob
+
+import jobwatch
+from jobwatch import patterns
+
+os.chdir(os.path.dirname(__file__))
+
+
+def test_pattern_risks():
+    assert patterns.pattern_risks(r'warning:\s+\d+\s') == []
+    assert patterns.pattern_risks('(?<!5OHW)FAIL(?!MODE)') == []
+    assert patterns.pattern_risks('(a+)+b') == ['nested unbounded quantifier']
+    assert patterns.pattern_risks('(foo|foobar)*x') == ['alternation under unbounded quantifier']
+    assert patterns.pattern_risks('error.*.*done') == ['adjacent identical unbounded quantifiers']
+
+
+def test_scaling_exponent():
+    # Wide margins around linear (1) and cubic (3) so machine load does not matter
+    assert patterns.scaling_exponent('error') < 1.5
+    assert patterns.scaling_exponent(r'\s*\w*\s*x') > 2.5
+
+
+def test_benchmark_patterns():
+    lines = patterns.read_lines(sorted(glob.glob('logs/*.log')))
+    results = patterns.benchmark_patterns({'warn', 'error', '(a+)+b'}, lines)
+    by_pattern = {result['pattern']: result for result in results}
+    assert set(by_pattern) == {'warn', 'error', '(a+)+b'}
+    assert by_pattern['error']['matches'] > 0
+    assert by_pattern['error']['risks'] == []
+    assert by_pattern['(a+)+b']['risks'] == ['nested unbounded quantifier']
+    assert by_pattern['(a+)+b']['scaling'] is None
+
+
+def test_max_line_length(monkeypatch):
+    monkeypatch.setattr(jobwatch.jobwatch, 'MAX_LINE_LENGTH', 10)
+    jw = jobwatch.JobWatch('errors', 'logs/errors.log', errors=('warn', 'error'))
+    # Only errors in the first 10 characters of each line are found
+    assert [line for _, line, _ in jw.found_errors] == [
+        line for line in jw.filelines
+        if 'warn' in line[:10].lower() or 'error' in line[:10].lower()]
+    assert 0 < len(jw.found_errors) < 5
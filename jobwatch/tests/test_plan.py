@@ -0,0 +1,143 @@
+import os
+import glob
+import warnings
+
+import pytest
+
+import jobwatch
+from jobwatch import plan
+
+os.chdir(os.path.dirname(__file__))
+
+CLASSES = {'JobWatch': jobwatch.JobWatch,
+           'FileWatch': jobwatch.FileWatch}
+
+CONFIG = """
+error_sets:
+  base_errs: [warn, error, fatal]
+  log_errs:
+    base: base_errs
+    remove: [fatal]
+    add: ['fail(?!ed ok)']
+
+watches:
+  - {class: JobWatch, task: errors, filename: logs/errors.log, errors: log_errs}
+  - {class: FileWatch, task: file, maxage: 1, filename: logs/errors.log}
+  - {class: JobWatch, task: errors, filename: logs/errors.log, errors: log_errs}
+  - {class: JobWatch, task: single, filename: logs/errors.log, errors: log_errs,
+     requires: does not exist}
+"""
+
+
+def test_resolve_error_sets():
+    error_sets = plan.resolve_error_sets(plan.yaml.safe_load(CONFIG)['error_sets'])
+    assert error_sets['base_errs'] == ['warn', 'error', 'fatal']
+    assert set(error_sets['log_errs']) == {'warn', 'error', 'fail(?!ed ok)'}
+    with pytest.raises(ValueError):
+        plan.resolve_error_sets({'a': {'base': 'b'}})
+
+
+def test_compile_plan():
+    watch_plan = plan.WatchPlan.compile(plan.yaml.safe_load(CONFIG), CLASSES)
+    assert watch_plan.n_duplicates == 1
+    assert [watch['args']['task'] for watch in watch_plan.watches] == ['errors', 'file', 'single']
+    # A single string that is not an error set is a single pattern
+    assert watch_plan.watches[2]['args']['requires'] == ['does not exist']
+    assert watch_plan.watches[1]['resource'] == ['file', 'task:file/logs/errors.log']
+
+    bad = plan.yaml.safe_load(CONFIG)
+    bad['watches'][0]['maxage_hours'] = 1
+    with pytest.raises(ValueError):
+        plan.WatchPlan.compile(bad, CLASSES)
+
+    risky = plan.yaml.safe_load(CONFIG)
+    risky['watches'][0]['errors'] = ['(a+)+b']
+    with warnings.catch_warnings(record=True) as warns:
+        warnings.simplefilter('always')
+        plan.WatchPlan.compile(risky, CLASSES)
+    assert any('nested unbounded quantifier' in str(warn.message) for warn in warns)
+
+
+def test_load_plan(tmpdir):
+    config_file = str(tmpdir.join('watch.yaml'))
+    with open(config_file, 'w') as fh:
+        fh.write(CONFIG)
+    cache_dir = str(tmpdir.join('cache'))
+
+    watch_plan = plan.load_plan(config_file, CLASSES, cache_dir=cache_dir)
+    cache_files = glob.glob(os.path.join(cache_dir, 'watch_plan_*.json'))
+    assert len(cache_files) == 1
+
+    # Cached plan is used without compiling the config again
+    compile_plan = plan.WatchPlan.compile
+    plan.WatchPlan.compile = None
+    try:
+        cached_plan = plan.load_plan(config_file, CLASSES, cache_dir=cache_dir)
+    finally:
+        plan.WatchPlan.compile = compile_plan
+    assert cached_plan.as_dict() == watch_plan.as_dict()
+
+    jws = cached_plan.evaluate(CLASSES)
+    assert [jw.task for jw in jws] == ['errors', 'file', 'single']
+    assert len(jws[0].found_errors) == 5
+    assert jws[2].missing_requires == {'does not exist'}
+
+    jws = cached_plan.evaluate(CLASSES, tasks='^single$')
+    assert [jw.task for jw in jws] == ['single']
+
+
+def test_load_plan_stale_cache(tmpdir, monkeypatch):
+    config_file = str(tmpdir.join('watch.yaml'))
+    with open(config_file, 'w') as fh:
+        fh.write(CONFIG)
+    cache_dir = str(tmpdir.join('cache'))
+    plan.load_plan(config_file, CLASSES, cache_dir=cache_dir)
+    cache_files = glob.glob(os.path.join(cache_dir, 'watch_plan_*.json'))
+
+    # A change in the watch class signatures or package version compiles a
+    # new plan, and the old one is removed
+    class NewFileWatch(jobwatch.FileWatch):
+        def __init__(self, task, maxage, filename, new_arg=None):
+            super().__init__(task, maxage, filename)
+
+    plan.load_plan(config_file, dict(CLASSES, FileWatch=NewFileWatch), cache_dir=cache_dir)
+    new_cache_files = glob.glob(os.path.join(cache_dir, 'watch_plan_*.json'))
+    assert len(new_cache_files) == 1
+    assert new_cache_files != cache_files
+
+    monkeypatch.setattr(plan, '__version__', 'new-version')
+    plan.load_plan(config_file, dict(CLASSES, FileWatch=NewFileWatch), cache_dir=cache_dir)
+    cache_files = glob.glob(os.path.join(cache_dir, 'watch_plan_*.json'))
+    assert len(cache_files) == 1
+    assert cache_files != new_cache_files
+
+
+def test_plan_groups():
+    config = plan.yaml.safe_load(CONFIG)
+    config['watches'] = {'a': config['watches'][:2], 'b': config['watches'][3:]}
+    assert len(plan.WatchPlan.compile(config, CLASSES, group='b').watches) == 1
+    with pytest.raises(ValueError):
+        plan.WatchPlan.compile(config, CLASSES, group='c')
+
+
+def test_shipped_config_patterns():
+    config = plan.load_config(os.path.join(os.path.dirname(plan.__file__), 'skawatch.yaml'))
+    patterns = plan.config_patterns(config)
+    assert 'traceback' in patterns
+    assert "traceback(?!': True)" in patterns
+    assert 'total size is' in patterns
+
+
+def test_evaluate_replace():
+    class NoFileWatch(jobwatch.FileWatch):
+        def __init__(self, *args, **kwargs):
+            raise AssertionError('watch owned by an agent was evaluated')
+
+    watch_plan = plan.WatchPlan.compile(plan.yaml.safe_load(CONFIG), CLASSES)
+    agent_results = [jobwatch.WatchResult(type='File', task='file', found_errors=[]),
+                     jobwatch.WatchResult(type='File', task='file', found_errors=[])]
+    jws = watch_plan.evaluate(dict(CLASSES, FileWatch=NoFileWatch),
+                              replace={('File', 'file'): agent_results})
+    assert [jw.task for jw in jws] == ['errors', 'file', 'file', 'single']
+    assert jws[1:3] == agent_results
+    assert jobwatch.merge_shards(jws, agent_results) == jws
@@ -0,0 +1,52 @@
+import os
+import pstats
+
+import jobwatch
+from jobwatch.profiling import RunProfiler, watch_type_breakdown
+
+os.chdir(os.path.dirname(__file__))
+
+
+def test_run_profiler(tmpdir):
+    profiler = RunProfiler(profile=True, trace_memory=True)
+    profiler.start()
+    jws = [jobwatch.JobWatch('errors', 'logs/errors.log', errors=('warn', 'error')),
+           jobwatch.FileWatch('stale', filename='logs/stale.log')]
+    jobwatch.report_rows(jws)
+    profiler.stop()
+
+    outfiles = profiler.write(str(tmpdir), jws, name='test')
+    assert sorted(os.path.basename(outfile) for outfile in outfiles) == [
+        'test.pstats', 'test_memory.txt', 'test_profile.txt', 'test_watches.txt']
+    breakdown = open(str(tmpdir.join('test_watches.txt'))).read()
+    assert 'File' in breakdown
+    assert 'Job' in breakdown
+
+
+def test_profile_report(tmpdir):
+    rows = jobwatch.report_rows([jobwatch.JobWatch('errors', 'logs/errors.log',
+                                                   errors=('warn', 'error'))])
+    profiler = RunProfiler(profile=True)
+    assert RunProfiler().report_workers(4) == 4
+    profiler.start()
+    jobwatch.make_html_report(rows, rootdir=str(tmpdir), just_status=True,
+                              workers=profiler.report_workers(4))
+    profiler.stop()
+
+    # Log pages are written in the profiled thread
+    functions = set(name for _, _, name in pstats.Stats(profiler.profiler).stats)
+    assert {'write_log_html', 'write_log_pages'} <= functions
+
+
+def test_run_profiler_disabled(tmpdir):
+    profiler = RunProfiler()
+    profiler.start()
+    profiler.stop()
+    assert profiler.write(str(tmpdir), []) == []
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_watch_type_breakdown():
+    jws = [jobwatch.JobWatch('errors', 'logs/errors.log', errors=('warn', 'error'))]
+    lines = watch_type_breakdown(jws).splitlines()
+    assert lines[1].split()[:2] == ['Job', '1']
@@ -15,14 +15,16 @@ else:
     data_files = None
 
 entry_points = {'console_scripts': ['skawatch_daily=jobwatch.skawatch:main',
-                                    'skawatch_hourly=jobwatch.hourly_watch:main']}
+                                    'skawatch_hourly=jobwatch.hourly_watch:main',
+                                    'skawatch_patterns=jobwatch.patterns:main',
+                                    'skawatch_errors=jobwatch.error_index:main']}
 
 setup(name='jobwatch',
       author='Tom Aldcroft',
       description='Watch ska jobs',
       author_email='taldcroft@cfa.harvard.edu',
       packages=['jobwatch'],
-      package_data={'jobwatch': ['*html', '*js']},
+      package_data={'jobwatch': ['*html', '*js', '*.yaml']},
       include_package_data=True,
       data_files=data_files,
       license=("New BSD/3-clause BSD License\nCopyright (c) 2019"